@@ -0,0 +1,237 @@
+#!/usr/bin/python
+"""Benchmark the stages of Speeda on synthetic speech-like audio.
+
+Usage examples:
+    ./bench.py --durations 1m,10m --rates 16000,44100 --save baseline.json
+    ./bench.py --durations 1m,10m --rates 16000,44100 --compare baseline.json
+    ./bench.py --durations 10m --rates 44100 --analysis-rate 16000
+"""
+
+import argparse
+import json
+import os
+import resource
+import shutil
+import sys
+import tempfile
+import time
+import wave
+
+import numpy as np
+
+import speeda
+
+STAGES = ['load_audio', 'harma', 'calc_vote_density', 'calc_segments',
+          'calc_ratios', 'gen_audio_clips', 'gen_melt_script']
+
+def gen_synthetic_audio(audio_file, duration, fs, seed=0):
+    """Write a deterministic speech-like WAV file.
+
+    Syllables are tone bursts (a fundamental of 100 - 250 Hz with two
+    harmonics, under a Hann envelope) separated by short gaps, with a longer
+    pause now and then, over a quiet noise floor. The file is written one
+    minute at a time, so any duration fits in memory.
+
+    Args:
+        audio_file: path of the WAV file to write.
+        duration: length of the audio (in second).
+        fs: sampling rate of the audio.
+        seed: seed of the random generator.
+    """
+    block_length = 60 * fs
+    total = int(duration * fs)
+    w = wave.open(audio_file, 'wb')
+    w.setnchannels(1)
+    w.setsampwidth(2)
+    w.setframerate(fs)
+    for n, block_start in enumerate(xrange(0, total, block_length)):
+        length = min(block_length, total - block_start)
+        rng = np.random.RandomState(seed * 1000003 + n)
+        block = 0.002 * rng.randn(length)
+        pos = int(rng.uniform(0, 0.2) * fs)
+        while pos < length:
+            burst = int(rng.uniform(0.08, 0.25) * fs)
+            end = min(pos + burst, length)
+            t = np.arange(end - pos) / float(fs)
+            f0 = rng.uniform(100, 250)
+            tone = sum(np.sin(2 * np.pi * f0 * h * t) / h for h in (1, 2, 3))
+            block[pos:end] += rng.uniform(0.1, 0.5) * np.hanning(burst)[
+                :end - pos] * tone
+            if rng.rand() < 0.15:
+                pos = end + int(rng.uniform(0.3, 1.2) * fs) # pause
+            else:
+                pos = end + int(rng.uniform(0.02, 0.08) * fs)
+        w.writeframes(speeda.float2pcm(block.clip(-1, 1), 'int16').tobytes())
+    w.close()
+
+def reset_peak_rss():
+    """Reset the peak RSS of this process, if the OS supports it (Linux)."""
+    try:
+        with open('/proc/self/clear_refs', 'w') as f:
+            f.write('5')
+    except IOError:
+        pass
+
+def peak_rss():
+    """Return the peak RSS (in bytes) since the last reset_peak_rss()."""
+    try:
+        with open('/proc/self/status') as f:
+            for line in f:
+                if line.startswith('VmHWM:'):
+                    return int(line.split()[1]) * 1024
+    except IOError:
+        pass
+    # Peak of the whole process (in KB on Linux).
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * 1024
+
+def run_stages(audio_file, duration, work_dir, engine, analysis_rate=None):
+    """Run every stage once, in pipeline order.
+
+    Args:
+        audio_file: path of the audio file.
+        duration: length of the audio (in second).
+        work_dir: directory for the audio clips.
+        engine: engine of gen_audio_clips().
+        analysis_rate: analysis rate of Harma, None for the rate of the audio.
+
+    Returns:
+        A dict of stage name to a dict of 'time' (in second), 'throughput'
+        (audio seconds per second) and 'peak_rss' (in bytes). With an
+        analysis rate, 'accuracy' is the comparison of the syllables with
+        those of full-rate analysis (see speeda.compare_syllables()), with
+        'full_rate_time' of Harma.
+    """
+    results = {}
+    def measure(name, func):
+        reset_peak_rss()
+        start = time.time()
+        value = func()
+        elapsed = time.time() - start
+        results[name] = {'time': elapsed,
+                         'throughput': duration / max(elapsed, 1e-9),
+                         'peak_rss': peak_rss()}
+        return value
+    audio, fs = measure('load_audio', lambda: speeda.load_audio(audio_file))
+    if analysis_rate is not None:
+        # decimate_audio() imports scipy.signal on its first call, which is
+        # not to be timed.
+        speeda.decimate_audio(np.zeros(2), 2)
+    syllable_times = measure('harma', lambda: speeda.detect_syllables(
+        audio, fs, analysis_rate=analysis_rate))
+    if analysis_rate is not None:
+        start = time.time()
+        reference = speeda.detect_syllables(audio, fs)
+        results['accuracy'] = speeda.compare_syllables(reference,
+                                                       syllable_times)
+        results['accuracy']['full_rate_time'] = time.time() - start
+    vote_density = measure('calc_vote_density',
+        lambda: speeda.calc_vote_density(syllable_times, audio, fs))
+    start_points = measure('calc_segments',
+                           lambda: speeda.calc_segments(vote_density))
+    def ratios():
+        density = speeda.calc_syllable_density(start_points, syllable_times)
+        return speeda.calc_ratios(start_points, density, 1.5, audio, fs)
+    speedup_ratio = measure('calc_ratios', ratios)
+    segments = speeda.create_segments(start_points, speedup_ratio)
+    clip_file = os.path.join(work_dir, 'clip.wav')
+    shutil.copy(audio_file, clip_file)
+    audio_clips = measure('gen_audio_clips',
+        lambda: speeda.gen_audio_clips(clip_file, segments, engine))
+    video_profile = (25, int(duration * 25))
+    measure('gen_melt_script', lambda: speeda.gen_melt_script(
+        os.path.join(work_dir, 'video.mp4'), segments, audio_clips,
+        video_profile))
+    return results
+
+def parse_duration(text):
+    """Parse a duration such as '90s', '10m' or '4h' to seconds."""
+    units = {'s': 1, 'm': 60, 'h': 3600}
+    if text[-1] in units:
+        return float(text[:-1]) * units[text[-1]]
+    return float(text)
+
+def compare(results, baseline, threshold, min_time=0.01):
+    """Compare results with a baseline.
+
+    Returns:
+        An array of strings describing the stages which are slower than the
+        baseline by more than 'threshold' (a fraction, e.g. 0.1 for 10%) and
+        by more than 'min_time' seconds (below which timing is mostly noise).
+    """
+    slowdowns = []
+    for case in sorted(results):
+        for stage in STAGES:
+            if stage not in results[case] or\
+                    stage not in baseline.get(case, {}):
+                continue
+            old = baseline[case][stage]['time']
+            new = results[case][stage]['time']
+            if new > old * (1 + threshold) and new - old > min_time:
+                slowdowns.append('%s %s: %.3fs -> %.3fs (+%.0f%%)' % (
+                    case, stage, old, new, (new / old - 1) * 100))
+    return slowdowns
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split('\n')[0])
+    parser.add_argument('--durations', default='1m,10m',
+                        help='comma-separated durations, e.g. 1m,30m,4h')
+    parser.add_argument('--rates', default='16000,44100',
+                        help='comma-separated sampling rates')
+    parser.add_argument('--engine', default='wsola', choices=['wsola', 'sox'],
+                        help='engine of gen_audio_clips()')
+    parser.add_argument('--save', help='save the results as a baseline')
+    parser.add_argument('--compare', help='baseline to compare with')
+    parser.add_argument('--threshold', type=float, default=0.1,
+                        help='slowdown (fraction) flagged by --compare')
+    parser.add_argument('--analysis-rate', type=int,
+                        help='analysis rate of Harma, reported against '
+                             'full-rate analysis')
+    args = parser.parse_args()
+
+    results = {}
+    work_dir = tempfile.mkdtemp(prefix='speeda_bench_')
+    try:
+        for duration_text in args.durations.split(','):
+            duration = parse_duration(duration_text)
+            for fs in [int(r) for r in args.rates.split(',')]:
+                case = '%s@%d' % (duration_text, fs)
+                audio_file = os.path.join(work_dir, 'synthetic.wav')
+                gen_synthetic_audio(audio_file, duration, fs)
+                results[case] = run_stages(audio_file, duration, work_dir,
+                                           args.engine, args.analysis_rate)
+                for name in os.listdir(work_dir):
+                    os.remove(os.path.join(work_dir, name))
+                print '%-12s %-18s %10s %14s %12s' % (
+                    'case', 'stage', 'time (s)', 'audio-s per s', 'peak MB')
+                for stage in STAGES:
+                    r = results[case][stage]
+                    print '%-12s %-18s %10.3f %14.1f %12.1f' % (
+                        case, stage, r['time'], r['throughput'],
+                        r['peak_rss'] / 1048576.0)
+                if 'accuracy' in results[case]:
+                    a = results[case]['accuracy']
+                    print ('%-12s harma at %d Hz: %.1fx faster, %d/%d '
+                           'syllables matched (recall %.3f, precision %.3f), '
+                           'start error %.1f ms (max %.1f), end error %.1f '
+                           'ms (max %.1f)') % (
+                        case, args.analysis_rate,
+                        a['full_rate_time'] / results[case]['harma']['time'],
+                        a['matched'], a['reference'], a['recall'],
+                        a['precision'], a['start_error'] * 1000,
+                        a['max_start_error'] * 1000, a['end_error'] * 1000,
+                        a['max_end_error'] * 1000)
+    finally:
+        shutil.rmtree(work_dir)
+    if args.save:
+        with open(args.save, 'w') as f:
+            json.dump(results, f, indent=2, sort_keys=True)
+    if args.compare:
+        with open(args.compare) as f:
+            slowdowns = compare(results, json.load(f), args.threshold)
+        for s in slowdowns:
+            print 'SLOWER', s
+        if slowdowns:
+            sys.exit(1)
+
+if __name__ == '__main__':
+    main()
@@ -1,54 +1,416 @@
 #!/usr/bin/python
 
+import argparse
+import BaseHTTPServer
+import contextlib
+import fractions
+import hashlib
+import io
+import json
 from lxml.builder import E
 import lxml.etree as ET
+import math
+import multiprocessing
+from multiprocessing.pool import ThreadPool
 import os
+import resource
+import shutil
+import signal
+import SocketServer
+import struct
 import subprocess
 import sys
+import tempfile
+import threading
+import time
 import warnings
+import wave
 
-import matplotlib.pyplot as plt
 import numpy as np
-import pylab
 import scipy
-import scipy.signal
 import scipy.io.wavfile
 
-def calc_speedup_ratio(audio_file, speed):
+# Parameters for Harma.
+HARMA_NFFT = 256
+HARMA_NOVERLAP = 128
+HARMA_MIN_DB = 20
+HARMA_KAISER_BETA = 0.5
+# Harma runs on batches of this many samples, each with its own cutoff.
+HARMA_BATCH_SIZE = 5000000
+# Memory ceiling (in bytes) of a block of the spectrogram.
+STFT_MAX_MEMORY = 32 * 1024 * 1024
+# Parameters for WSOLA (in second).
+WSOLA_FRAME_LENGTH = 0.03
+WSOLA_TOLERANCE = 0.01
+# Length (in second) of the cross-fade between stretched segments.
+CROSSFADE_LENGTH = 0.005
+# Analysis cache. Bump CACHE_VERSION when the analysis changes.
+CACHE_DIR = os.path.expanduser('~/.cache/speeda')
+CACHE_MAX_SIZE = 256 * 1024 * 1024
+CACHE_VERSION = 4
+# Age (in second) after which a temporary file of save_analysis() is left
+# over by a killed process, rather than still being written.
+CACHE_TMP_MAX_AGE = 60
+# Record arrays of syllables and segments. Time is in second. An element of
+# a segment array has the same attributes as a Segment instance.
+SYLLABLE_DTYPE = np.dtype([('start', np.float64), ('end', np.float64)])
+SEGMENT_DTYPE = np.dtype([('start', np.float64), ('end', np.float64),
+                          ('ratio', np.float64)])
+# Adjacent segments whose ratios differ by at most COALESCE_TOLERANCE are
+# merged, up to COALESCE_MAX_LENGTH seconds (None for no limit).
+COALESCE_TOLERANCE = 0
+COALESCE_MAX_LENGTH = 30
+# Sampling rate (in Hz) Harma analyzes audio at, e.g. 16000. None for the
+# rate of the audio. See detect_syllables().
+ANALYSIS_SAMPLE_RATE = None
+# Sampling rate (in Hz) of the audio decoded from a video by 'ffmpeg'.
+DECODE_SAMPLE_RATE = 44100
+# Samples read from the 'ffmpeg' pipe at once.
+DECODE_BLOCK_SIZE = 1 << 16
+# Source length (in second) of a chunk encoded by an 'ffmpeg' process of
+# render_ffmpeg().
+FFMPEG_CHUNK_LENGTH = 60
+# Encoding options of render_ffmpeg().
+FFMPEG_ENCODE_ARGS = ['-c:v', 'libx264', '-preset', 'veryfast', '-crf', '20',
+                      '-pix_fmt', 'yuv420p', '-c:a', 'aac', '-b:a', '128k']
+# Encoding options of render_ffmpeg() for a preview, which is also scaled
+# to PREVIEW_HEIGHT lines.
+FFMPEG_PREVIEW_ARGS = ['-c:v', 'libx264', '-preset', 'ultrafast',
+                       '-crf', '32', '-pix_fmt', 'yuv420p',
+                       '-c:a', 'aac', '-b:a', '64k']
+PREVIEW_HEIGHT = 270
+# Length (in second) of a Harma batch of stream_segments().
+STREAM_BATCH_LENGTH = 5
+# Port of the job queue of serve(), on localhost.
+DAEMON_PORT = 8395
+# Options of the jobs of serve() which a request may set.
+DAEMON_OPTIONS = ('speed', 'output_dir', 'engine', 'backend', 'preview',
+                  'analysis_rate')
+
+def calc_speedup_ratio(audio_file, speed, cache_dir=CACHE_DIR, processes=1,
+                       analysis_rate=ANALYSIS_SAMPLE_RATE):
     """Calculate adaptive speed-up ratio in the audio.
 
     Args:
         audio_file: path of the audio file.
         speed: desired speed specified by user.
+        cache_dir: directory of the analysis cache, None to disable caching.
+        processes: the number of processes running Harma.
+        analysis_rate: sampling rate Harma analyzes the audio at, None for
+            the rate of the audio. See detect_syllables().
 
     Returns:
-        An array of Segment instances, which are segments (including its own
-        speedup ratio) of this audio.
+        A record array of segments (SEGMENT_DTYPE), each with its own speedup
+        ratio, of this audio.
     """
-    audio, fs = load_audio(audio_file)
+    return calc_speedup_ratios(audio_file, [speed], cache_dir, processes,
+                               analysis_rate)[0]
+
+def calc_speedup_ratios(audio_file, speeds, cache_dir=CACHE_DIR,
+                        processes=1, analysis_rate=ANALYSIS_SAMPLE_RATE):
+    """Calculate adaptive speed-up ratio in the audio for several speeds.
+
+    The audio is analyzed once; only the ratios are calculated per speed.
+
+    Args:
+        audio_file: path of the audio file.
+        speeds: an array of desired speeds.
+        cache_dir: directory of the analysis cache, None to disable caching.
+        processes: the number of processes running Harma.
+        analysis_rate: see calc_speedup_ratio().
+
+    Returns:
+        An array of record arrays of segments (SEGMENT_DTYPE), one for each
+        speed. All speeds share the same segment boundaries, but for segments
+        merged by coalesce_segments().
+    """
+    syllable_times, vote_density, start_points, audio_length =\
+        analyze_audio(audio_file, cache_dir, processes, analysis_rate)
+    # calculate syllable density of each segment
+    with timed('calc_syllable_density'):
+        syllable_density = calc_syllable_density(start_points, syllable_times)
+    # list of ratio of each speed
+    with timed('calc_ratios'):
+        speedup_ratios = calc_ratios_for_speeds(start_points, syllable_density,
+                                                speeds, audio_length)
+    segment_lists = [create_segments(start_points, speedup_ratio)
+                     for speedup_ratio in speedup_ratios]
+    with timed('coalesce_segments'):
+        segment_lists = [coalesce_segments(segments)
+                         for segments in segment_lists]
+    if active_hooks():
+        for segments in segment_lists:
+            count('segments', len(segments))
+            count('distinct_ratios', np.unique(segments.ratio).size)
+    return segment_lists
+
+def create_segments(start_points, speedup_ratio):
+    """Create segments from segment's start points and ratios.
+
+    Args:
+        start_points: an array of segment's start time (in ms).
+        speedup_ratio: an array of each segment's speedup ratio.
+
+    Returns:
+        A record array of segments (SEGMENT_DTYPE).
+    """
+    start_points = np.asarray(start_points, dtype=np.float64) / 1000
+    ratio = np.around(np.asarray(speedup_ratio[:start_points.size - 1],
+                                 dtype=np.float64), decimals=2)
+    ratio = np.fmax(0.1, np.fmin(100, ratio)) # nan as 100, like min()
+    # (optional, used to lower memory requirement) quantize speedup ratio
+    ratio = quantize_speedup_ratios(ratio)
+    return np.rec.fromarrays([start_points[:-1], start_points[1:], ratio],
+                             dtype=SEGMENT_DTYPE)
+
+def coalesce_segments(segments, tolerance=COALESCE_TOLERANCE,
+                      max_length=COALESCE_MAX_LENGTH):
+    """Merge runs of adjacent segments of the same speed-up ratio, so there
+    are as many audio clips and MLT clips as ratio changes.
+
+    A segment joins the run before it if its ratio differs from the ratio of
+    the run's first segment by at most 'tolerance', and the run doesn't get
+    longer than 'max_length' by it. A merged segment keeps the length of its
+    sped-up output, i.e. its ratio is the length of the run over the sum of
+    each segment's output length, quantized.
+
+    Args:
+        segments: an array of segments.
+        tolerance: the largest difference of ratios merged. 0 to only merge
+            equal ratios.
+        max_length: the longest merged segment (in second), None for no
+            limit.
+
+    Returns:
+        A record array of the merged segments (SEGMENT_DTYPE).
+    """
+    segments = segment_array(segments)
+    if segments.size == 0:
+        return segments
+    starts = segments.start.tolist()
+    ends = segments.end.tolist()
+    ratios = segments.ratio.tolist()
+    firsts = [0]
+    for i in xrange(1, len(ratios)):
+        first = firsts[-1]
+        too_long = max_length is not None and\
+                   ends[i] - starts[first] > max_length
+        if abs(ratios[i] - ratios[first]) > tolerance or too_long:
+            firsts.append(i)
+    firsts = np.array(firsts)
+    lasts = np.concatenate((firsts[1:], [segments.size])) - 1
+    start, end = segments.start[firsts], segments.end[lasts]
+    output_length = np.add.reduceat((segments.end - segments.start) /
+                                    segments.ratio, firsts)
+    ratio = np.where(firsts == lasts, segments.ratio[firsts],
+                     quantize_speedup_ratios((end - start) / output_length))
+    count('segments_coalesced', segments.size - firsts.size)
+    return np.rec.fromarrays([start, end, ratio], dtype=SEGMENT_DTYPE)
+
+def segment_array(segments):
+    """Create a record array of segments (SEGMENT_DTYPE) from an array of
+    Segment instances. A record array of segments is returned as is."""
+    if getattr(segments, 'dtype', None) == SEGMENT_DTYPE:
+        return segments.view(np.recarray)
+    return np.rec.fromrecords([(s.start, s.end, s.ratio) for s in segments],
+                              dtype=SEGMENT_DTYPE).reshape(-1)
+
+def stream_segments(blocks, fs, speed, batch_length=STREAM_BATCH_LENGTH):
+    """Calculate adaptive speed-up ratio of audio arriving block by block.
+
+    Segments are yielded as soon as they are final, i.e. once the audio is
+    known up to a bounded look-ahead past the end of the segment: the Harma
+    batch ('batch_length'), the vote window (0.3 s), half of the median
+    window (75 ms), and up to the minimal segment length (400 ms) to find the
+    next segment's start. The segment boundaries are the same as those of
+    calc_speedup_ratio() with HARMA_BATCH_SIZE of 'batch_length', but the
+    ratios target the speed by a running estimate of the desired ratio, as
+    the density and length of the whole audio aren't known yet.
+
+    Args:
+        blocks: an iterable of arrays of audio data (float), e.g. from
+            iter_blocks().
+        fs: sampling rate of the audio.
+        speed: desired speed specified by user.
+        batch_length: length (in second) of a Harma batch.
+
+    Yields:
+        Segment instances, in chronological order.
+    """
+    stream = SegmentStream(fs, speed, batch_length)
+    for block in blocks:
+        for s in stream.feed(block):
+            yield s
+    for s in stream.close():
+        yield s
+
+def iter_blocks(audio, block_size):
+    """Generate consecutive blocks of 'block_size' samples of audio data."""
+    for start in xrange(0, audio.shape[0], block_size):
+        yield audio[start:start + block_size]
+
+def analyze_audio(audio_file, cache_dir=CACHE_DIR, processes=1,
+                  analysis_rate=ANALYSIS_SAMPLE_RATE):
+    """Run the stages of the analysis which don't depend on the speed.
+
+    Results are cached in 'cache_dir', keyed by the content of the audio file
+    and the analysis parameters. The audio is only loaded if the results
+    aren't cached, so a video isn't decoded again.
+
+    Args:
+        audio_file: path of the audio file, or of a video.
+        cache_dir: directory of the analysis cache, None to disable caching.
+        processes: the number of processes running Harma.
+        analysis_rate: see detect_syllables().
+
+    Returns:
+        A tuple of (syllable_times, vote_density, start_points, audio_length),
+        where audio_length is the length of the audio (in ms). See
+        detect_syllables(), calc_vote_density() and calc_segments().
+    """
+    if cache_dir is not None:
+        with timed('load_analysis'):
+            key = analysis_cache_key(audio_file, analysis_rate)
+            analysis = load_analysis(cache_dir, key)
+        if analysis is not None:
+            count('cache_hits')
+            return analysis
+        count('cache_misses')
+    # A video is decoded at the analysis rate by 'ffmpeg' (which costs
+    # nothing more) rather than decimated, keeping the time resolution of
+    # Harma at DECODE_SAMPLE_RATE.
+    full_rate = None
+    decode_rate = DECODE_SAMPLE_RATE
+    if analysis_rate is not None and\
+            os.path.splitext(audio_file)[1].lower() != '.wav':
+        decode_rate = min(int(analysis_rate), DECODE_SAMPLE_RATE)
+        full_rate = DECODE_SAMPLE_RATE
+    with timed('load_audio'):
+        audio, fs = load_audio(audio_file, decode_rate)
     # list of tuple (start, end)
-    syllable_times = detect_syllables(audio, fs)
+    with timed('detect_syllables'):
+        syllable_times = detect_syllables(audio, fs, processes,
+                                          analysis_rate, full_rate)
     # calcDensity() + calcDensityMedian() => list of density
-    vote_density = calc_vote_density(syllable_times, audio, fs)
+    with timed('calc_vote_density'):
+        vote_density = calc_vote_density(syllable_times, audio, fs)
     # calcSegments() + mergeSegments() => list of segment's start point
-    start_points = calc_segments(vote_density)
-    # calculate syllable density of each segment
-    syllable_density = calc_syllable_density(start_points, syllable_times)
-    # list of ratio
-    speedup_ratio = calc_ratios(start_points, syllable_density, speed, audio,
-                                fs)
-    # Create all segments.
-    segments = []
-    for i in xrange(1, len(start_points)):
-        ratio = np.around(speedup_ratio[i - 1], decimals=2)
-        s = Segment(float(start_points[i - 1]) / 1000,\
-                    float(start_points[i]) / 1000,\
-                    max(0.1, min(100, ratio)))
-        segments.append(s)
-    # (optional, used to lower memory requirement) quantize speedup ratio
-    for s in segments:
-        s.ratio = quantize_speedup_ratio(s.ratio)
-    return segments
+    with timed('calc_segments'):
+        start_points = calc_segments(vote_density)
+    audio_length = float(audio.size) / fs * 1000
+    analysis = (syllable_times, vote_density, start_points, audio_length)
+    if cache_dir is not None:
+        # Caching is best-effort: the analysis is done anyway.
+        with timed('save_analysis'):
+            try:
+                save_analysis(cache_dir, key, analysis)
+            except (IOError, OSError):
+                count('cache_save_errors')
+    return analysis
+
+def analysis_cache_key(audio_file, analysis_rate=None):
+    """Return the cache key of an audio file's analysis.
+
+    The key is the SHA-1 of the file content, the rate a video is decoded at,
+    the analysis rate and every parameter the analysis depends on, so
+    changing a parameter invalidates the cached results. It doesn't need the
+    audio to be loaded.
+    """
+    h = hashlib.sha1()
+    params = (CACHE_VERSION, HARMA_NFFT, HARMA_NOVERLAP, HARMA_MIN_DB,
+              HARMA_KAISER_BETA, HARMA_BATCH_SIZE, DECODE_SAMPLE_RATE,
+              analysis_rate)
+    h.update(repr(params))
+    with open(audio_file, 'rb') as f:
+        for chunk in iter(lambda: f.read(1 << 20), b''):
+            h.update(chunk)
+    return h.hexdigest()
+
+def load_analysis(cache_dir, key):
+    """Load cached analysis results, None if there isn't any."""
+    path = os.path.join(cache_dir, key + '.npz')
+    try:
+        with np.load(path) as data:
+            analysis = (syllable_array(data['syllable_times']),
+                        data['vote_density'].astype(np.float64),
+                        data['start_points'].astype(np.int64),
+                        float(data['audio_length']))
+    except (IOError, KeyError, ValueError):
+        return None
+    try:
+        os.utime(path, None) # mark as recently used
+    except OSError: # evicted by another process since loaded
+        pass
+    return analysis
+
+def save_analysis(cache_dir, key, analysis, max_size=CACHE_MAX_SIZE):
+    """Save analysis results to the cache, and evict the least recently used
+    results until the cache is no larger than 'max_size' bytes.
+
+    Several processes may save to the same cache at the same time: each
+    writes its own temporary file, renamed to the entry in one step, and
+    entries evicted by another process are skipped. Temporary files older
+    than CACHE_TMP_MAX_AGE seconds, left over by killed processes, are
+    removed.
+
+    Raises:
+        IOError, OSError: the results could not be written.
+    """
+    syllable_times, vote_density, start_points, audio_length = analysis
+    make_dirs(cache_dir)
+    # Votes are small integers, stored in the smallest type that holds them.
+    max_vote = int(vote_density.max()) if vote_density.size else 0
+    path = os.path.join(cache_dir, key + '.npz')
+    fd, tmp_path = tempfile.mkstemp(suffix='.npz.tmp', dir=cache_dir)
+    try:
+        with os.fdopen(fd, 'wb') as f:
+            np.savez_compressed(f,
+                syllable_times=np.asarray(syllable_array(syllable_times)),
+                vote_density=vote_density.astype(
+                    np.min_scalar_type(max_vote)),
+                start_points=np.asarray(start_points, dtype=np.int64),
+                audio_length=np.float64(audio_length))
+        os.rename(tmp_path, path)
+    except:
+        os.remove(tmp_path)
+        raise
+    # LRU eviction. Temporary files left over by killed processes are
+    # removed.
+    entries = []
+    now = time.time()
+    for name in os.listdir(cache_dir):
+        if not name.endswith(('.npz', '.npz.tmp')):
+            continue
+        try:
+            stat = os.stat(os.path.join(cache_dir, name))
+        except OSError: # evicted by another process
+            continue
+        if name.endswith('.npz'):
+            entries.append((stat.st_mtime, stat.st_size, name))
+        elif now - stat.st_mtime > CACHE_TMP_MAX_AGE:
+            try:
+                os.remove(os.path.join(cache_dir, name))
+            except OSError: # removed by another process
+                pass
+    total = sum(size for _, size, _ in entries)
+    for _, size, name in sorted(entries):
+        if total <= max_size:
+            break
+        if name == key + '.npz': # just saved
+            continue
+        try:
+            os.remove(os.path.join(cache_dir, name))
+        except OSError: # evicted by another process
+            pass
+        total -= size
+
+def make_dirs(path):
+    """Create a directory and its parents, unless it exists already."""
+    try:
+        os.makedirs(path)
+    except OSError:
+        if not os.path.isdir(path):
+            raise
 
 def quantize_speedup_ratio(ratio):
     """Return quantized speedup ratio as multiple of 0.25. e.g. 1.25, 3.00."""
@@ -56,40 +418,244 @@ def quantize_speedup_ratio(ratio):
         return 0.25
     return round(ratio * 4) / 4
 
-def detect_syllables(audio, fs):
+def quantize_speedup_ratios(ratios):
+    """Quantize an array of speedup ratios, like quantize_speedup_ratio()."""
+    # round() rounds half away from zero, np.round() to even.
+    return np.maximum(np.floor(np.asarray(ratios) * 4 + 0.5) / 4, 0.25)
+
+def detect_syllables(audio, fs, processes=1, analysis_rate=None,
+                     full_rate=None):
     """Detect syllables' timing from audio data.
 
     Args:
         audio: audio data.
         fs: sampling rate of the audio.
+        processes: the number of processes running Harma.
+        analysis_rate: the lowest sampling rate to analyze the audio at. The
+            audio is decimated by the integer factor fs // analysis_rate (if
+            at least 2) before Harma. None to analyze the audio at its own
+            rate.
+        full_rate: the sampling rate whose time resolution Harma keeps, e.g.
+            the rate of a video decoded at a lower rate. None for 'fs'. The
+            frame size and overlap of Harma are scaled by the ratio of the
+            rate of analysis to it.
 
     Returns:
-        An array of tuple (start_time, end_time) of detected syllables. The
-        array is sorted chronologically by the occurence of syllables.
+        A record array (SYLLABLE_DTYPE) of detected syllables. The array is
+        sorted chronologically by the occurence of syllables.
     """
-    syllables = harma_batch(audio, fs)
-    print len(syllables)
-    syllable_times = []
-    for s in syllables:
-        start = np.amin(s.times)
-        end = np.amax(s.times)
-        syllable_times.append((start, end))
-    return sorted(syllable_times)
+    factor = decimation_factor(fs, analysis_rate)
+    if factor > 1:
+        with timed('decimate_audio'):
+            audio = decimate_audio(audio, factor)
+    rate = fs / float(factor)
+    scale = (fs if full_rate is None else full_rate) / rate
+    if scale != 1:
+        nfft = int(round(HARMA_NFFT / scale))
+        syllables = harma_batch(audio, rate, processes=processes, nfft=nfft,
+                                noverlap=nfft * HARMA_NOVERLAP // HARMA_NFFT,
+                                batch_size=int(HARMA_BATCH_SIZE / scale))
+    else:
+        syllables = harma_batch(audio, fs, processes=processes)
+    count('syllables', syllables.size)
+    return syllables
+
+def decimation_factor(fs, analysis_rate):
+    """Return the factor detect_syllables() decimates audio by, the largest
+    integer keeping the rate at least 'analysis_rate' (1 for None)."""
+    if analysis_rate is None:
+        return 1
+    return max(1, int(fs // analysis_rate))
 
-def harma_batch(audio, fs):
-    """Perform Harma in batch manner (shorter audio), so specgram() doesn't
-    run out of memory."""
-    STEP_SIZE = 5000000
+def decimate_audio(audio, factor, block_size=1 << 15):
+    """Low-pass filter and downsample audio data by an integer factor.
+
+    The anti-alias filter is a Kaiser-windowed FIR filter, like that of
+    scipy.signal.resample_poly() but shorter, as Harma only uses the peak
+    magnitude of each frame. It is applied in polyphase form: the audio is
+    seen as rows of 'factor' samples, one row per output sample, and each
+    output is the sum of the rows around it, each multiplied by its part of
+    the filter. Only the outputs kept are computed, in float32. The audio
+    is filtered block by block, each block reading enough samples around it
+    for the filter, so only the decimated audio is held in memory as a
+    whole.
+
+    Args:
+        audio: audio data.
+        factor: the decimation factor.
+        block_size: the number of input samples filtered at once.
+
+    Returns:
+        An array of the decimated audio data (float32), sample i at sample
+        i * factor of the audio.
+    """
+    from scipy.signal import firwin # slow to import
+    half_rows = 6 # half length of the filter, in rows
+    half_length = half_rows * factor
+    taps = np.zeros((2 * half_rows + 1) * factor, dtype=np.float32)
+    taps[:2 * half_length + 1] = firwin(2 * half_length + 1, 1.0 / factor,
+                                        window=('kaiser', 5.0))
+    # Row k of the filter weighs input row j - half_rows + k of output j.
+    taps = taps.reshape(-1, factor)
     length = audio.shape[0]
-    syllables = []
-    for start in xrange(0, length, STEP_SIZE):
-        end = min(start + STEP_SIZE, length)
-        batch_syllables = harma(audio[start:end], fs)
-        # Offset syllable time by batch's start time
-        for s in batch_syllables:
-            s.times = [t + float(start) / fs for t in s.times]
-        syllables += batch_syllables
-    return syllables
+    out = np.empty(-(-length // factor), dtype=np.float32)
+    block_rows = max(1, block_size // factor)
+    for first_row in xrange(0, out.size, block_rows):
+        rows = min(block_rows, out.size - first_row)
+        start = (first_row - half_rows) * factor
+        end = (first_row + rows + half_rows) * factor
+        # Zeros before the start and after the end of the audio.
+        block = np.zeros(end - start, dtype=np.float32)
+        block[max(-start, 0):min(length, end) - start] =\
+            audio[max(start, 0):min(length, end)]
+        block = block.reshape(-1, factor)
+        acc = block[:rows].dot(taps[0])
+        for k in xrange(1, taps.shape[0]):
+            acc += block[k:k + rows].dot(taps[k])
+        out[first_row:first_row + rows] = acc
+    return out
+
+def compare_syllables(reference, syllables, tolerance=0.02):
+    """Compare detected syllables with reference ones, e.g. syllables
+    detected at a lower analysis rate with those of full-rate analysis.
+
+    A syllable matches the reference syllable with the nearest start, if
+    both starts and ends are at most 'tolerance' seconds apart.
+
+    Args:
+        reference: a record array of the reference syllables.
+        syllables: a record array of the syllables to compare.
+        tolerance: the largest difference (in second) of a match.
+
+    Returns:
+        A dict of 'reference' and 'syllables' (the number of syllables),
+        'matched' (the number of matches), 'recall' and 'precision', and the
+        mean and max absolute difference (in second) of the start and end
+        times of the matches ('start_error', 'max_start_error', 'end_error'
+        and 'max_end_error').
+    """
+    reference = syllable_array(reference)
+    syllables = syllable_array(syllables)
+    report = {'reference': int(reference.size),
+              'syllables': int(syllables.size)}
+    if reference.size and syllables.size:
+        # Index of the syllable with the nearest start.
+        right = np.minimum(np.searchsorted(syllables.start, reference.start),
+                           syllables.size - 1)
+        left = np.maximum(right - 1, 0)
+        nearest = np.where(np.abs(syllables.start[left] - reference.start) <=
+                           np.abs(syllables.start[right] - reference.start),
+                           left, right)
+        start_error = np.abs(syllables.start[nearest] - reference.start)
+        end_error = np.abs(syllables.end[nearest] - reference.end)
+        matched = (start_error <= tolerance) & (end_error <= tolerance)
+        # A syllable matches one reference syllable at most.
+        matched &= np.concatenate(([True], nearest[1:] != nearest[:-1]))
+        start_error, end_error = start_error[matched], end_error[matched]
+    else:
+        matched = start_error = end_error = np.zeros(0)
+    report['matched'] = int(np.count_nonzero(matched))
+    report['recall'] = report['matched'] / float(max(reference.size, 1))
+    report['precision'] = report['matched'] / float(max(syllables.size, 1))
+    for name, error in [('start_error', start_error),
+                        ('end_error', end_error)]:
+        report[name] = float(error.mean()) if error.size else 0.0
+        report['max_' + name] = float(error.max()) if error.size else 0.0
+    return report
+
+def harma_batch(audio, fs, max_memory=STFT_MAX_MEMORY, processes=1,
+                nfft=None, noverlap=None, batch_size=None):
+    """Perform Harma in batch manner (shorter audio), so each batch has its own
+    cutoff and the spectrogram never has to be held in memory as a whole.
+
+    The spectrogram is streamed in blocks of at most 'max_memory' bytes, and
+    frames overlapping two batches are analyzed like any other frame. A
+    syllable reaching the end of a batch is merged with the syllable starting
+    at the beginning of the next batch.
+
+    Args:
+        audio: audio data.
+        fs: sampling rate of the audio.
+        max_memory: memory ceiling (in bytes) of a spectrogram block, in each
+            process.
+        processes: the number of processes running batches at the same time.
+            The processes are forked, so they share the audio data with this
+            process instead of receiving a copy.
+        nfft: the number of samples of a spectrogram frame, None for
+            HARMA_NFFT.
+        noverlap: the number of samples shared by consecutive frames, None
+            for HARMA_NOVERLAP.
+        batch_size: the number of samples of a batch, None for
+            HARMA_BATCH_SIZE.
+
+    Returns:
+        A record array (SYLLABLE_DTYPE) of the detected syllables, sorted by
+        time.
+    """
+    global shared_audio
+    nfft = HARMA_NFFT if nfft is None else nfft
+    noverlap = HARMA_NOVERLAP if noverlap is None else noverlap
+    batch_size = HARMA_BATCH_SIZE if batch_size is None else batch_size
+    hop = nfft - noverlap
+    batch_frames = max(1, batch_size // hop)
+    block_frames = max(1, max_memory // stft_frame_bytes(nfft))
+    frame_count = count_frames(audio.shape[0], nfft, noverlap)
+    batches = [(start, min(start + batch_frames, frame_count), frame_count,
+                block_frames, nfft, noverlap)
+               for start in xrange(0, frame_count, batch_frames)]
+    shared_audio = audio
+    try:
+        if processes > 1 and len(batches) > 1:
+            pool = multiprocessing.Pool(min(processes, len(batches)))
+            try:
+                # map() keeps the order of batches.
+                batch_syllables = pool.map(harma_batch_job, batches)
+            finally:
+                pool.close()
+                pool.join()
+        else:
+            batch_syllables = [harma_batch_job(batch) for batch in batches]
+    finally:
+        shared_audio = None
+    for frames in batch_syllables:
+        count('harma_iterations', len(frames))
+    frames = np.concatenate([np.array(frames, dtype=np.int64).reshape(-1, 2)
+                             for frames in batch_syllables] +
+                            [np.zeros((0, 2), dtype=np.int64)])
+    frames = frames[np.argsort(frames[:, 0])]
+    # A syllable starting a batch continues the syllable ending right before.
+    starts, ends = frames[:, 0], frames[:, 1]
+    crossing = (starts[1:] % batch_frames == 0) & (ends[:-1] + 1 == starts[1:])
+    first = np.concatenate(([True], ~crossing))
+    last = np.concatenate((~crossing, [True]))
+    return syllable_array(frame_time(starts[first], fs, nfft, noverlap),
+                          frame_time(ends[last], fs, nfft, noverlap))
+
+# Audio data of harma_batch(), inherited by the processes of its pool.
+shared_audio = None
+
+def harma_batch_job(batch):
+    """Run Harma on a batch of harma_batch().
+
+    Args:
+        batch: a tuple of (batch_start, batch_end, frame_count,
+            block_frames, nfft, noverlap), the range of frames of this batch,
+            the number of frames of the audio, the frames in a spectrogram
+            block and the frame size and overlap.
+
+    Returns:
+        An array of tuple (start_frame, end_frame) of the detected syllables.
+    """
+    batch_start, batch_end, frame_count, block_frames, nfft, noverlap = batch
+    freqMax = np.concatenate([np.amax(mag, axis=0) for _, mag in
+                              stft_blocks(shared_audio, block_frames,
+                                          batch_start, batch_end, nfft,
+                                          noverlap)])
+    # Syllables extend onto the edges of a batch only at joins with other
+    # batches, so a single batch gives the syllables of harma().
+    frames = harma_frames(freqMax, include_start=batch_start > 0,
+                          include_end=batch_end < frame_count)
+    return [(start + batch_start, end + batch_start) for start, end in frames]
 
 def harma(audio, fs):
     """Detect syllables by the Harma algorithm.
@@ -99,93 +665,178 @@ def harma(audio, fs):
         fs: sampling rate of the audio.
 
     Returns:
-        An array of Syllable instances, the detected syllables.
+        A record array (SYLLABLE_DTYPE) of the detected syllables, in the
+        order they are found.
     """
-    # Parameters for harma.
-    nfft = 256
-    window = np.kaiser(nfft, 0.5)
-    minDB = 20
-    noverlap = 128
-    # Calculate spectrogram.
-    mag, F, T, _ = pylab.specgram(audio, Fs=fs, window=window,
-                                  noverlap=noverlap, NFFT=nfft,
-                                  mode='magnitude')
-    # Initialize segmentation parameters.
+    block_frames = max(1, STFT_MAX_MEMORY // stft_frame_bytes(HARMA_NFFT))
+    freqMax = np.concatenate([np.amax(mag, axis=0) for _, mag in
+                              stft_blocks(audio, block_frames)])
+    frames = np.array(harma_frames(freqMax), dtype=np.int64).reshape(-1, 2)
+    return syllable_array(frame_time(frames[:, 0], fs),
+                          frame_time(frames[:, 1], fs))
+
+def harma_frames(freqMax, include_start=False, include_end=False):
+    """Segment spectrogram frames into syllables by the Harma algorithm.
+
+    Frames are visited from the loudest peak downwards (frames already claimed
+    by a syllable are skipped), and each syllable grows from its peak to both
+    sides until the peak magnitude drops more than HARMA_MIN_DB below the
+    syllable's own peak. The result is the same as repeatedly rescanning the
+    spectrogram for its maximum and clearing the found syllable, but runs in
+    O(frames log frames) instead of O(syllables * bins * frames).
+
+    Args:
+        freqMax: an array of the peak magnitude of each frame.
+        include_start: if False, a syllable is never extended onto the first
+            frame unless that frame is its peak (like the original scan of
+            Harma does). True where the frames continue those of another
+            batch.
+        include_end: the same for the last frame.
+
+    Returns:
+        An array of tuple (start_frame, end_frame), both inclusive, of the
+        detected syllables, in the order they are found.
+    """
+    minDB = HARMA_MIN_DB
+    # Peak magnitude (in dB) of each frame. A cleared frame is set to -inf.
+    with warnings.catch_warnings(): # suppress divide-by-zero warning
+        warnings.simplefilter('ignore')
+        amps = 20 * np.log10(freqMax)
+    # Frames sorted by descending peak (ties: earlier frame first).
+    order = np.argsort(-freqMax, kind='mergesort')
     syllables = []
-    cutoff = None
+    if order.size == 0 or freqMax[order[0]] <= 0:
+        return syllables
+    # Frames quieter than the cutoff never start a syllable.
+    cutoff = amps[order[0]] - minDB
+    order = order[amps[order] >= cutoff]
+    # Scan boundaries, exclusive.
+    left = -1 if include_start else 0
+    right = amps.size if include_end else amps.size - 1
     # Segment signals into syllables.
-    while True:
-        # Find the maximum remaining magnitude in the spectrogram.
-        freqMax = np.amax(mag, axis=0)
-        freqIndex = mag.argmax(axis=0)
-        argMax = np.amax(freqMax)
-        segmentIndex = freqMax.argmax()
-        # Clear temp variables for this iteration.
-        times = np.zeros(shape=0)
-        segments = np.zeros(shape=0, dtype=np.int)
-        freqs = np.zeros(shape=0)
-        amps = np.zeros(shape=0)
-        # Setup temp variables with initial values.
-        segments = np.append(segments, segmentIndex)
-        times = np.append(times, T[segmentIndex])
-        freqs = np.append(freqs, F[freqIndex[segmentIndex]])
-        amps = np.append(amps, 20 * np.log10(argMax))
-        # Check if this is the first iteration,
-        # if so store the cutoff value for the loop.
-        if cutoff is None:
-            cutoff = amps[0] - minDB
-        # Is it time to stop looking for syllables?
-        if amps[0] < cutoff:
-            break
-        minAmp = amps[0] - minDB
-        i = 0
-        # Look for all the values less than t with a high enough amplitude.
-        t = segmentIndex
-        while t > 0 and amps[i] >= minAmp:
-            t -= 1
-            i += 1
-            segments = np.append(segments, t)
-            times = np.append(times, T[t])
-            freqs = np.append(freqs, F[freqIndex[t]])
-            with warnings.catch_warnings(): # suppress divide-by-zero warning
-                warnings.simplefilter('ignore')
-                amps = np.append(amps, 20 * np.log10(freqMax[t]))
-        # Remove the last index because it did not meet criteria.
-        if i > 0:
-            segments = np.delete(segments, i)
-            times = np.delete(times, i)
-            freqs = np.delete(freqs, i)
-            amps = np.delete(amps, i)
-            i -= 1
-        # Look for all the values less than t with a high enough amplitude.
-        while t < freqIndex.size - 1 and amps[i] >= minAmp:
-            t += 1
-            i += 1
-            segments = np.append(segments, t)
-            times = np.append(times, T[t])
-            freqs = np.append(freqs, F[freqIndex[t]])
-            with warnings.catch_warnings(): # suppress divide-by-zero warning
-                warnings.simplefilter('ignore')
-                amps = np.append(amps, 20 * np.log10(freqMax[t]))
-        # Remove the last index because it did not meet criteria.
-        if i > 0:
-            segments = np.delete(segments, i)
-            times = np.delete(times, i)
-            freqs = np.delete(freqs, i)
-            amps = np.delete(amps, i)
-            i -= 1
-        # Store syllable parameters in struct. (irrelevant things are ignored)
-        syllable = Syllable(times)
-        syllables.append(syllable)
+    for segmentIndex in order:
+        if amps[segmentIndex] == -np.inf:
+            continue # already part of a syllable
+        minAmp = amps[segmentIndex] - minDB
+        start = find_run_edge(amps, segmentIndex - 1, left, -1, minAmp) + 1
+        end = find_run_edge(amps, segmentIndex + 1, right, 1, minAmp) - 1
+        start, end = min(start, segmentIndex), max(end, segmentIndex)
+        syllables.append((start, end))
         # Clear the magnitudes for this syllable so that it is not found again.
-        mag[:, segments] = 0
+        amps[start:end + 1] = -np.inf
     return syllables
 
+def find_run_edge(amps, first, stop, step, min_amp):
+    """Find the first frame whose amplitude is lower than 'min_amp'.
+
+    Frames are scanned from 'first' towards 'stop' (exclusive) in windows of
+    doubling size, so a syllable costs time proportional to its own length.
+
+    Args:
+        amps: an array of peak amplitude (in dB) of each frame.
+        first: index of the first frame to check.
+        stop: index where the scan stops.
+        step: 1 to scan forwards, -1 to scan backwards.
+        min_amp: the minimal amplitude of a frame in the run.
+
+    Returns:
+        Index of the first frame below 'min_amp', or 'stop' if there is none.
+    """
+    size = 32
+    pos = first
+    while (stop - pos) * step > 0:
+        if step > 0:
+            end = min(pos + size, stop)
+            below = np.flatnonzero(amps[pos:end] < min_amp)
+        else:
+            end = max(pos - size, stop)
+            below = np.flatnonzero(amps[end + 1:pos + 1][::-1] < min_amp)
+        if below.size:
+            return pos + step * int(below[0])
+        pos = end
+        size *= 2
+    return stop
+
+def stft_blocks(audio, block_frames, start=0, stop=None, nfft=HARMA_NFFT,
+                noverlap=HARMA_NOVERLAP):
+    """Generate the magnitude spectrogram of Harma block by block.
+
+    Same as pylab.specgram(mode='magnitude') with Harma's parameters, but at
+    most 'block_frames' frames are computed at once. Each block reads the
+    samples it shares with the next block, so no frame is lost at a block
+    boundary.
+
+    Args:
+        audio: audio data.
+        block_frames: the maximal number of frames in a block.
+        start: index of the first frame to generate.
+        stop: index of the frame to stop at (exclusive). None for the end.
+        nfft: the number of samples of a frame.
+        noverlap: the number of samples shared by consecutive frames.
+
+    Yields:
+        A tuple of (first_frame, mag), where mag is an array of shape
+        (frequency bins, frames), the magnitude of the frames starting at
+        'first_frame'.
+    """
+    hop = nfft - noverlap
+    window = np.kaiser(nfft, HARMA_KAISER_BETA)
+    scale = np.abs(window).sum()
+    if audio.shape[0] < nfft:
+        # zero pad audio up to nfft, as specgram() does.
+        audio = np.concatenate((audio[:], np.zeros(nfft - audio.shape[0],
+                                                   dtype=audio.dtype)))
+    if stop is None:
+        stop = count_frames(audio.shape[0], nfft, noverlap)
+    for first in xrange(start, stop, block_frames):
+        last = min(first + block_frames, stop)
+        block = audio[first * hop:(last - 1) * hop + nfft]
+        frames = np.lib.stride_tricks.as_strided(block,
+            shape=(last - first, nfft),
+            strides=(hop * block.strides[0], block.strides[0]))
+        mag = np.abs(np.fft.rfft(frames * window, axis=1)) / scale
+        yield first, mag.T
+
+def stft_frame_bytes(nfft):
+    """Return the memory (in bytes) stft_blocks() takes for a frame."""
+    # windowed samples, complex spectrum and magnitude, all 64-bit.
+    return nfft * 8 + (nfft // 2 + 1) * (16 + 8)
+
+def count_frames(length, nfft=HARMA_NFFT, noverlap=HARMA_NOVERLAP):
+    """Return the number of spectrogram frames of 'length' audio samples."""
+    hop = nfft - noverlap
+    return (max(length, nfft) - noverlap) // hop
+
+def frame_time(frame, fs, nfft=HARMA_NFFT, noverlap=HARMA_NOVERLAP):
+    """Return the time (in second) of a spectrogram frame, or an array of
+    frames."""
+    hop = nfft - noverlap
+    return (frame * hop + nfft // 2) / float(fs)
+
+def syllable_array(start, end=None):
+    """Create a record array of syllables (SYLLABLE_DTYPE).
+
+    Args:
+        start: an array of syllable's start time, or (if 'end' is None) an
+            array of tuple (start, end) or a record array of syllables.
+        end: an array of syllable's end time.
+
+    Returns:
+        A record array of syllables, which is 'start' itself if it is one.
+    """
+    if end is None:
+        if getattr(start, 'dtype', None) == SYLLABLE_DTYPE:
+            return start.view(np.recarray)
+        times = np.asarray(start, dtype=np.float64).reshape(-1, 2)
+        start, end = times[:, 0], times[:, 1]
+    return np.rec.fromarrays([start, end], dtype=SYLLABLE_DTYPE)
+
 def calc_vote_density(syllable_times, audio, fs):
     """Calculate the vote density given timing of syllables.
 
     Args:
-        syllable_times: an array of tuple (start, end), each syllable's timing.
+        syllable_times: a record array of syllables (or an array of tuple
+            (start, end)), each syllable's timing.
         audio: audio data.
         fs: sampling rate of the audio.
 
@@ -193,22 +844,49 @@ def calc_vote_density(syllable_times, audio, fs):
         An array of the vote density, having the same length as the audio data.
         The vote density is median-filtered.
     """
-    # Compute density by voting.
+    # Compute density by voting. Each syllable adds 1 to a difference array at
+    # the start of its voting range and subtracts 1 at the end.
     voteWindow = 0.3 # in second
-    vote_density = np.zeros(int(float(audio.size) / fs * 1000), # in ms
-                            dtype=np.uint32)
-    for start, end in syllable_times:
-        vote_start = int(np.floor((start - voteWindow) * 1000)) - 1
-        vote_end = int(np.floor((end + voteWindow) * 1000))
-        if vote_start < 0:
-            vote_start = 0
-        if vote_end > vote_density.size:
-            vote_end = vote_density.size
-        for i in xrange(vote_start, vote_end):
-            vote_density[i] += 1
+    size = int(float(audio.size) / fs * 1000) # in ms
+    times = syllable_array(syllable_times)
+    vote_start = np.floor((times.start - voteWindow) * 1000).astype(int) - 1
+    vote_end = np.floor((times.end + voteWindow) * 1000).astype(int)
+    vote_start = np.clip(vote_start, 0, size)
+    vote_end = np.clip(vote_end, 0, size)
+    voted = vote_start < vote_end
+    diff = np.bincount(vote_start[voted], minlength=size + 1) -\
+           np.bincount(vote_end[voted], minlength=size + 1)
+    vote_density = np.cumsum(diff[:size]).astype(np.uint32)
     # Median filtering
     window_size = 151
-    return scipy.signal.medfilt(vote_density, window_size)
+    with timed('median_filter'):
+        return running_median(vote_density, window_size)
+
+def running_median(votes, window_size):
+    """Median-filter an array of small non-negative integers.
+
+    Same as scipy.signal.medfilt() (zero-padded at both ends), but in
+    O(n * max(votes)) time. The median of a window is at least k if and only if
+    more than half of the window is at least k, so the median is the number of
+    such k, each counted with a cumulative sum.
+
+    Args:
+        votes: an array of non-negative integers.
+        window_size: size of the median filter, an odd number.
+
+    Returns:
+        An array of the median-filtered votes (as float64, like medfilt()).
+    """
+    half = window_size // 2
+    padded = np.concatenate((np.zeros(half, dtype=votes.dtype), votes,
+                             np.zeros(half, dtype=votes.dtype)))
+    median = np.zeros(votes.size)
+    counts = np.zeros(padded.size + 1, dtype=np.int32)
+    max_vote = int(votes.max()) if votes.size else 0
+    for k in xrange(1, max_vote + 1):
+        np.cumsum(padded >= k, out=counts[1:])
+        median += (counts[window_size:] - counts[:-window_size]) > half
+    return median
 
 def calc_segments(vote_density):
     """Calculate segments from the vote density.
@@ -219,30 +897,32 @@ def calc_segments(vote_density):
     Returns:
         An array of segment's start time.
     """
-    # Calculate the splitting points of segments.
-    seg_points = np.array([0], dtype=np.uint32)
-    in_valley = True
-    valley_start = 0
-    for m in xrange(1, vote_density.size):
-        if vote_density[m - 1] < vote_density[m]:
-            if in_valley: # valley ends
-                seg_points = np.append(seg_points, [valley_start, m])
-            in_valley = False
-        elif vote_density[m - 1] > vote_density[m]:
-            valley_start = m
-            in_valley = True
+    # Calculate the splitting points of segments. Each valley (the points
+    # between a fall and the next rise of the density) adds its start and end.
+    changes = np.flatnonzero(np.diff(vote_density)) + 1
+    rising = vote_density[changes] > vote_density[changes - 1]
+    # A rise ends a valley unless the previous change was also a rise.
+    valley_ends = rising & np.concatenate(([True], ~rising[:-1]))
+    valley_starts = np.concatenate(([0], changes[:-1]))
+    valley_count = np.count_nonzero(valley_ends)
+    seg_points = np.empty(2 * valley_count + 2, dtype=np.int64)
+    seg_points[0] = 0
+    seg_points[1:-1:2] = valley_starts[valley_ends]
+    seg_points[2:-1:2] = changes[valley_ends]
     # Make sure 'seg_points' has the end point of 'vote_density'.
-    if seg_points[-1] != vote_density.size:
-        seg_points = np.append(seg_points, vote_density.size - 1);
-    # Merge splitting points to create segment start points.
+    seg_points[-1] = vote_density.size - 1
+    # Merge splitting points to create segment start points: each start point
+    # is the first splitting point more than 'min_segment_length' after the
+    # previous one.
     min_segment_length = 400 # in ms
-    start_points = np.array([0])
-    seg_start = seg_points[0]
-    for m in xrange(1, seg_points.size):
-        if seg_points[m] - seg_start > min_segment_length:
-            start_points = np.append(start_points, seg_points[m])
-            seg_start = seg_points[m]
-    return start_points
+    next_points = np.searchsorted(seg_points, seg_points + min_segment_length,
+                                  side='right')
+    start_points = [0]
+    m = next_points[0]
+    while m < seg_points.size:
+        start_points.append(seg_points[m])
+        m = next_points[m]
+    return np.array(start_points, dtype=np.int64)
 
 def calc_ratios(start_points, syllable_density, speed, audio, fs):
     """Calculate speedup ratio of segments.
@@ -257,71 +937,141 @@ def calc_ratios(start_points, syllable_density, speed, audio, fs):
     Returns:
         An array of each segment's speedup ratio.
     """
+    return calc_ratios_for_speeds(start_points, syllable_density, [speed],
+                                  float(audio.size) / fs * 1000)[0]
+
+def calc_ratios_for_speeds(start_points, syllable_density, speeds,
+                           audio_length):
+    """Calculate speedup ratio of segments for several speeds.
+
+    Everything but the desired ratio is calculated once for all speeds.
+
+    Args:
+        start_points: an array of segment's start time.
+        syllable_density: an array of segment's syllable density.
+        speeds: an array of desired speeds.
+        audio_length: length of the audio (in ms).
+
+    Returns:
+        An array of arrays of each segment's speedup ratio, one for each speed.
+    """
     pause_time = 150 # desired pause time (in ms)
     avg_density = np.mean(syllable_density)
+    seg_length = np.diff(start_points)
+    pauses = (syllable_density == 0) & (seg_length > pause_time)
     # Pause count and speak time.
-    pause_count = 0
-    speak_time = 0
-    for m in xrange(1, start_points.size):
-        seg_start, seg_end = start_points[m - 1], start_points[m]
-        if syllable_density[m - 1] == 0 and seg_end - seg_start > pause_time:
-            pause_count += 1
-        else:
-            ratio = avg_density / syllable_density[m - 1]
-            speak_time += float(seg_end - 1 - seg_start) / ratio
-    # Calculate desired ratio.
-    audio_length = float(audio.size) / fs * 1000 # audio length in ms.
-    expected_time = audio_length / speed
-    desired_ratio = speak_time / (expected_time - pause_count * pause_time)
-    # speed up
-    speedup_ratio = np.zeros(0)
-    for m in xrange(1, start_points.size):
-        seg_start, seg_end = start_points[m - 1], start_points[m]
-        if syllable_density[m - 1] == 0 and seg_end - seg_start > pause_time:
-            ratio = (seg_end - 1 - seg_start) / pause_time
-        else:
-            ratio = avg_density * desired_ratio / syllable_density[m - 1]
-        speedup_ratio = np.append(speedup_ratio, ratio)
-    return speedup_ratio
+    pause_count = np.count_nonzero(pauses)
+    with np.errstate(divide='ignore', invalid='ignore'):
+        ratio = avg_density / syllable_density[~pauses]
+        speak_time = np.sum((seg_length[~pauses] - 1) / ratio)
+    pause_ratio = (seg_length - 1) // pause_time
+    speedup_ratios = []
+    for speed in speeds:
+        # Calculate desired ratio.
+        expected_time = audio_length / speed
+        desired_ratio = speak_time / (expected_time - pause_count * pause_time)
+        # speed up
+        with np.errstate(divide='ignore', invalid='ignore'):
+            speedup_ratio = np.where(pauses, pause_ratio,
+                avg_density * desired_ratio / syllable_density)
+        speedup_ratios.append(speedup_ratio)
+    return speedup_ratios
 
 def calc_syllable_density(start_points, syllable_times):
     """Calculate the syllable density of each segment.
 
     Args:
         start_points: an array of segment's start time.
-        syllable_times: an array of tuple (start, end), each syllable's timing.
+        syllable_times: a record array of syllables (or an array of tuple
+            (start, end)), each syllable's timing.
 
     Returns:
         An array of syllable density of each segment.
     """
-    syllable_density = np.zeros(len(start_points) - 1)
-    index = 0
-    for i in xrange(1, len(start_points)):
-        count = 0
-        while index < len(syllable_times) and\
-                1000 * syllable_times[index][0] < start_points[i]:
-            index += 1
-            count += 1
-        syllable_density[i - 1] = float(count) /\
-                                  (start_points[i] - start_points[i - 1])
-    return syllable_density
-
-def load_audio(audio_file):
+    starts = 1000 * syllable_array(syllable_times).start
+    # Number of syllables starting before each segment ends.
+    counts = np.searchsorted(starts, start_points[1:], side='left')
+    counts = np.diff(np.concatenate(([0], counts)))
+    return counts / np.diff(start_points).astype(np.float64)
+
+def load_audio(audio_file, sample_rate=DECODE_SAMPLE_RATE):
     """Load audio data given the audio file path.
 
+    The PCM data of a WAV file is memory-mapped rather than read, and only
+    converted to float when a part of it is sliced, so loading a long
+    recording takes little memory. Any other file (e.g. a video) is decoded
+    by decode_audio(), without writing a WAV file.
+
     Args:
-        audio_file: path of the audio file.
+        audio_file: path of the audio file, or of a video.
+        sample_rate: sampling rate of the audio decoded from a file other
+            than WAV.
 
     Returns:
-        A tuple of (data, sample_rate). The data is normalized to [-1, 1].
+        A tuple of (data, sample_rate). The data is a PcmAudio instance, whose
+        slices are normalized to [-1, 1].
     """
+    if os.path.splitext(audio_file)[1].lower() != '.wav':
+        # The blocks are copied into one buffer, grown in place (by realloc)
+        # rather than copied, so the audio is held only once.
+        pcm = np.empty(0, dtype=np.int16)
+        size = 0
+        for block in decode_audio(audio_file, sample_rate):
+            if size + block.size > pcm.size:
+                pcm.resize(max(size + block.size, pcm.size * 3 // 2),
+                           refcheck=False)
+            pcm[size:size + block.size] = block
+            size += block.size
+        pcm.resize(size, refcheck=False)
+        return PcmAudio(pcm, 'float32'), sample_rate
     # Suppress the warning from scipy loading wav audio_file.
     with warnings.catch_warnings():
         warnings.simplefilter('ignore')
-        sample_rate, audio = scipy.io.wavfile.read(audio_file)
-    mono = audio[:, 0] # only the first channel is used
-    normalized = pcm2float(mono, 'float32')
-    return normalized, sample_rate
+        try:
+            sample_rate, audio = scipy.io.wavfile.read(audio_file, mmap=True)
+        except ValueError: # e.g. 24-bit PCM can't be memory-mapped.
+            sample_rate, audio = scipy.io.wavfile.read(audio_file)
+    if audio.ndim > 1:
+        audio = audio[:, 0] # only the first channel is used (as a view)
+    return PcmAudio(audio, 'float32'), sample_rate
+
+def decode_audio(media_file, sample_rate=DECODE_SAMPLE_RATE,
+                 block_size=DECODE_BLOCK_SIZE):
+    """Decode the audio of a video (or any file 'ffmpeg' reads) block by
+    block, from the pipe of an 'ffmpeg' process.
+
+    Args:
+        media_file: path of the video.
+        sample_rate: sampling rate of the decoded audio. 'ffmpeg' resamples
+            the audio to it.
+        block_size: the maximal number of samples in a block.
+
+    Yields:
+        Arrays of mono (the channels are mixed down) 16-bit PCM samples. See
+        pcm2float() for float data, e.g. for stream_segments().
+
+    Raises:
+        RuntimeError: 'ffmpeg' failed.
+    """
+    count('decodes_spawned')
+    p = subprocess.Popen(['ffmpeg', '-loglevel', 'error', '-i', media_file,
+                          '-vn', '-ac', '1', '-ar', str(sample_rate),
+                          '-f', 's16le', '-acodec', 'pcm_s16le', '-'],
+                         stdout=subprocess.PIPE, bufsize=-1)
+    try:
+        while True:
+            data = p.stdout.read(2 * block_size)
+            if len(data) < 2:
+                break
+            yield np.frombuffer(data[:len(data) // 2 * 2], dtype='<i2')
+        if p.wait() != 0:
+            raise RuntimeError('ffmpeg failed to decode audio of ' +
+                               media_file)
+    finally:
+        if p.poll() is None: # the generator is closed before the end
+            p.kill()
+            p.wait()
+        p.stdout.close()
 
 def pcm2float(sig, dtype='float64'):
     """Convert WAV signal from integer to float point value with range [-1, 1].
@@ -337,39 +1087,311 @@ def pcm2float(sig, dtype='float64'):
 
     # Note that 'min' has a greater (by 1) absolute value than 'max'!
     # Therefore, we use '-min' here to avoid clipping.
-    return sig.astype(dtype) / dtype.type(-np.iinfo(sig.dtype).min)
+    normalized = sig.astype(dtype)
+    normalized /= dtype.type(-np.iinfo(sig.dtype).min)
+    return normalized
+
+def float2pcm(sig, dtype='int16'):
+    """Convert floating point signal with range [-1, 1] to PCM (integer).
 
-def gen_audio_clips(audio_file, segments):
-    """Use command 'sox' to generate audio clips with adaptive speed
-        corresponding to each video segment.
+    (Excerpted from mgeier on Github).
+    """
+    sig = np.asarray(sig)
+    if sig.dtype.kind != 'f':
+        raise TypeError("'sig' must be a float array")
+    dtype = np.dtype(dtype)
+    if dtype.kind != 'i':
+        raise TypeError("'dtype' must be signed integer type")
+
+    i = np.iinfo(dtype)
+    abs_max = 2 ** (i.bits - 1)
+    offset = i.min + abs_max
+    return (sig * abs_max + offset).clip(i.min, i.max).astype(dtype)
+
+def wsola(audio, ratio, fs):
+    """Time-stretch audio by WSOLA (waveform-similarity overlap-add).
+
+    Frames are taken from the input every 'ratio' * hop samples and overlap-
+    added every hop samples. Each frame is shifted (within WSOLA_TOLERANCE) to
+    the position most similar to the natural continuation of the previous
+    frame, so the pitch is preserved, like 'sox tempo -s' does.
 
     Args:
-        audio_file: path of the audio file.
+        audio: audio data (an array of float).
+        ratio: speed-up ratio, e.g. 2 halves the length of the audio.
+        fs: sampling rate of the audio.
+
+    Returns:
+        The stretched audio, an array of float32.
+    """
+    from scipy.signal import fftconvolve # slow to import, only needed here
+    x = np.asarray(audio, dtype=np.float32)
+    frame_length = 2 * max(1, int(WSOLA_FRAME_LENGTH * fs / 2))
+    hop = frame_length // 2
+    tolerance = int(WSOLA_TOLERANCE * fs)
+    window = np.hanning(frame_length).astype(np.float32)
+    out_length = int(round(x.size / float(ratio)))
+    frame_count = out_length // hop + 1
+    positions = np.around(np.arange(frame_count) * hop * ratio).astype(int)
+    # Pad the input so every candidate frame (and its continuation) exists.
+    padded_length = positions[-1] + 2 * tolerance + frame_length + hop
+    padded = np.zeros(max(padded_length, x.size + tolerance),
+                      dtype=np.float32)
+    padded[tolerance:tolerance + x.size] = x
+    out = np.zeros(frame_count * hop + frame_length, dtype=np.float32)
+    weight = np.zeros(out.size, dtype=np.float32)
+    position = 0
+    for k in xrange(frame_count):
+        if k > 0 and tolerance > 0:
+            # Natural continuation of the previous frame.
+            natural = padded[position + hop:position + hop + frame_length]
+            region = padded[positions[k]:
+                            positions[k] + 2 * tolerance + frame_length]
+            similarity = fftconvolve(region, natural[::-1], mode='valid')
+            position = positions[k] + int(np.argmax(similarity))
+        else:
+            position = positions[k] + tolerance
+        out[k * hop:k * hop + frame_length] +=\
+            window * padded[position:position + frame_length]
+        weight[k * hop:k * hop + frame_length] += window
+    out[weight > 1e-8] /= weight[weight > 1e-8]
+    return out[:out_length]
+
+def stretch_segments(audio, fs, segments, continuous=False):
+    """Time-stretch each segment of the audio by its speed-up ratio.
+
+    Clips are stretched one at a time, so only the clip being written is
+    held in memory.
+
+    Args:
+        audio: audio data.
+        fs: sampling rate of the audio.
         segments: an array of segments.
+        continuous: if False, yields a clip for each segment, which (like the
+            clips of gen_audio_clips()) keeps 1 more second at its end. If
+            True, yields the stretched track of all segments, cross-faded at
+            joins, one block per segment.
+
+    Yields:
+        The stretched clips, or the blocks of the stretched track (float32).
+    """
+    audio_end = min(int(round(segments[-1].end * fs)), audio.shape[0])
+    if not continuous:
+        for s in segments:
+            # preserve 1 second at the end of each segment,
+            # for MELT (the video editor) to grab frames.
+            start = int(round(s.start * fs))
+            end = min(int(round((s.end + 1) * fs)), audio_end)
+            yield wsola(audio[start:end], s.ratio, fs)
+        return
+    crossfade = int(CROSSFADE_LENGTH * fs)
+    fade_in = np.linspace(0, 1, crossfade, endpoint=False).astype(np.float32)
+    bounds = segment_array(segments)
+    lengths = np.floor((bounds.end - bounds.start) * fs / bounds.ratio +
+                       0.5).astype(int)
+    # The faded-out tail of the track so far, which overlaps the head of the
+    # next segment.
+    tail = np.zeros(crossfade, dtype=np.float32)
+    position = 0
+    for s, length in zip(segments, lengths):
+        # Stretch a little more than the segment, to fade out at the join.
+        start = int(round(s.start * fs))
+        end = min(int(round(s.end * fs + crossfade * s.ratio)), audio_end)
+        clip = wsola(audio[start:end], s.ratio, fs)[:length + crossfade]
+        head = min(crossfade, clip.size)
+        if position > 0:
+            clip[:head] *= fade_in[:head]
+        block = np.zeros(length + crossfade, dtype=np.float32)
+        block[:clip.size] = clip
+        block[:crossfade] += tail
+        tail = block[length:] * (1 - fade_in)
+        position += length
+        yield block[:length]
+
+def write_audio(audio_file, audio, fs):
+    """Write float audio data with range [-1, 1] to a 16-bit WAV file."""
+    scipy.io.wavfile.write(audio_file, fs, float2pcm(audio, 'int16'))
+
+def write_audio_blocks(audio_file, blocks, fs):
+    """Write blocks of float audio data with range [-1, 1] to a 16-bit WAV
+    file, one block at a time."""
+    with contextlib.closing(wave.open(audio_file, 'wb')) as w:
+        w.setnchannels(1)
+        w.setsampwidth(2)
+        w.setframerate(int(fs))
+        for block in blocks:
+            # WAV samples are little-endian.
+            w.writeframes(float2pcm(block, 'int16').astype('<i2').tobytes())
+
+def gen_audio_clips(audio_file, segments, engine='sox', workers=1,
+                    base_name=None):
+    """Generate audio clips with adaptive speed corresponding to each video
+        segment, with command 'sox' or in-process WSOLA.
+
+    Args:
+        audio_file: path of the audio file (or of a video, with 'wsola').
+        segments: an array of segments.
+        engine: 'sox' to run 'sox' for each clip, or 'wsola' to stretch the
+            clips by wsola() from the loaded audio, without any process.
+        workers: the number of 'sox' processes run at the same time. If more
+            than 1, the audio file is split into chunks first, so each process
+            only reads the range of its own clip.
+        base_name: name the clips are numbered after, in the directory of the
+            audio file, None for the name of the audio file. Clips of
+            different segments (e.g. of another speed) need another name.
 
     Returns:
         An array of paths to the audio clip of its video segment.
+
+    Raises:
+        RuntimeError: 'sox' failed for some segments.
     """
-    base_name, extension = os.path.splitext(audio_file)
+    base_path, extension = os.path.splitext(audio_file)
+    if base_name is not None:
+        base_path = os.path.join(os.path.dirname(audio_file), base_name)
+    if engine == 'wsola':
+        extension = '.wav' # the source may be a video
+    output_files = [base_path + '_' + str(i) + extension
+                    for i in xrange(len(segments))]
+    audio_clips = [os.path.split(f)[1] for f in output_files]
+    if engine == 'wsola':
+        with timed('gen_audio_clips'):
+            audio, fs = load_audio(audio_file)
+            for i, clip in enumerate(stretch_segments(audio, fs, segments)):
+                write_audio(output_files[i], clip, fs)
+        return audio_clips
     audio_end = segments[-1].end
-    audio_clips = []
+    jobs = []
     for i in xrange(len(segments)):
         s = segments[i]
-        output_file = base_name + '_' + str(i) + extension
-        audio_clips.append(os.path.split(output_file)[1])
         # preserve 1 second at the end of each segment,
         # for MELT (the video editor) to grab frames.
         end = s.end + 1
         if end > audio_end:
             end = audio_end
-        # Run 'sox' to generate audio clips.
-        p = subprocess.call(['sox', audio_file, output_file,\
-                             'trim', '%.3f' % s.start, '=%.3f' % end,\
-                             'tempo', '-s', '%.2f' % s.ratio])
+        jobs.append((audio_file, output_files[i], s.start, end, s.ratio))
+    with timed('gen_audio_clips'):
+        if workers <= 1:
+            return_codes = [run_sox(job) for job in jobs]
+        else:
+            tmp_dir = tempfile.mkdtemp(prefix='speeda_')
+            try:
+                jobs = split_source(audio_file, jobs, workers * 4, tmp_dir)
+                pool = ThreadPool(workers)
+                try:
+                    # map() keeps the order of jobs.
+                    return_codes = pool.map(with_thread_hooks(run_sox),
+                                            jobs)
+                finally:
+                    pool.close()
+                    pool.join()
+            finally:
+                shutil.rmtree(tmp_dir)
+    failures = ['%d (exit status %d)' % (i, code)
+                for i, code in enumerate(return_codes) if code != 0]
+    if failures:
+        raise RuntimeError('sox failed for segments: ' + ', '.join(failures))
     return audio_clips
 
+def gen_audio_track(audio_file, segments, base_name=None):
+    """Generate one audio track of all segments, each stretched by WSOLA to
+    its speed-up ratio, for write_melt_script() to refer to by in and out
+    points.
+
+    Args:
+        audio_file: path of the audio file, or of a video.
+        segments: an array of segments.
+        base_name: see gen_audio_clips().
+
+    Returns:
+        Path to the audio track, relative to the directory of the audio file.
+    """
+    base_path = os.path.splitext(audio_file)[0]
+    if base_name is not None:
+        base_path = os.path.join(os.path.dirname(audio_file), base_name)
+    output_file = base_path + '_track.wav'
+    with timed('gen_audio_track'):
+        audio, fs = load_audio(audio_file)
+        write_audio_blocks(output_file, stretch_segments(
+            audio, fs, segments, continuous=True), fs)
+    return os.path.split(output_file)[1]
+
+def gen_audio_clips_multi(audio_file, segment_lists, engine='sox', workers=1):
+    """Generate audio clips for several arrays of segments (e.g. the segments
+    of several speeds). A clip shared by more than one array is generated once.
+
+    Args:
+        audio_file: path of the audio file.
+        segment_lists: an array of arrays of segments.
+        engine: see gen_audio_clips().
+        workers: see gen_audio_clips().
+
+    Returns:
+        An array of arrays of paths to the audio clip of each video segment.
+    """
+    segment_lists = [segment_array(segments) for segments in segment_lists]
+    keys, index = np.unique(np.concatenate(segment_lists),
+                            return_inverse=True)
+    audio_clips = gen_audio_clips(audio_file, keys.view(np.recarray), engine,
+                                  workers)
+    offsets = np.cumsum([0] + [segments.size for segments in segment_lists])
+    return [[audio_clips[i] for i in index[start:end]]
+            for start, end in zip(offsets[:-1], offsets[1:])]
+
+def run_sox(job):
+    """Run 'sox' to generate an audio clip.
+
+    Args:
+        job: a tuple of (source_file, output_file, start, end, ratio), where
+            start and end are the time (in second) of the clip in the source.
+
+    Returns:
+        The exit status of 'sox'.
+    """
+    source_file, output_file, start, end, ratio = job
+    count('clips_spawned')
+    with timed('sox', 'subprocess'):
+        return subprocess.call(['sox', source_file, output_file,\
+                                'trim', '%.3f' % start, '=%.3f' % end,\
+                                'tempo', '-s', '%.2f' % ratio])
+
+def split_source(audio_file, jobs, chunk_count, tmp_dir):
+    """Split the audio file into chunks of consecutive clips.
+
+    Args:
+        audio_file: path of the audio file.
+        jobs: an array of jobs of run_sox(), sorted by time.
+        chunk_count: the number of chunks.
+        tmp_dir: directory to write the chunks to.
+
+    Returns:
+        An array of the same jobs, reading from the chunks instead.
+    """
+    with warnings.catch_warnings():
+        warnings.simplefilter('ignore')
+        try:
+            fs, pcm = scipy.io.wavfile.read(audio_file, mmap=True)
+        except ValueError: # e.g. 24-bit PCM can't be memory-mapped.
+            fs, pcm = scipy.io.wavfile.read(audio_file)
+    chunk_jobs = []
+    groups = np.array_split(np.arange(len(jobs)), chunk_count)
+    for n, group in enumerate(groups):
+        if group.size == 0:
+            continue
+        first = int(np.floor(jobs[group[0]][2] * fs))
+        last = int(np.ceil(max(jobs[i][3] for i in group) * fs))
+        chunk_file = os.path.join(tmp_dir, 'chunk_%d.wav' % n)
+        scipy.io.wavfile.write(chunk_file, fs, pcm[first:last])
+        offset = float(first) / fs
+        for i in group:
+            _, output_file, start, end, ratio = jobs[i]
+            chunk_jobs.append((chunk_file, output_file,
+                               max(0.0, start - offset), end - offset, ratio))
+    return chunk_jobs
+
 def render(video_file, sh_script_path, mlt_script_path, target_path,\
-           segments, audio_clips):
+           segments, audio_clips, video_profile=None, audio_track=None,
+           preview=False):
     """Generate render scripts, then render the output video.
 
     Args:
@@ -379,25 +1401,196 @@ def render(video_file, sh_script_path, mlt_script_path, target_path,\
         target_path: path to the output video.
         segments: an array of segments.
         audio_clips: an array of paths to the audio clip of its video segment.
+        video_profile: (frame_rate, frame_length) of the video, None to get it
+            by get_video_profiles().
+        audio_track: path to one audio track of all segments, used instead of
+            'audio_clips'. See write_melt_script().
+        preview: if True, render a low-resolution preview. See
+            gen_bash_script().
     """
     # Generate BASH script.
-    bash_script = gen_bash_script(mlt_script_path, target_path)
+    bash_script = gen_bash_script(mlt_script_path, target_path, preview)
     with open(sh_script_path, 'w') as f:
         f.write(bash_script)
     # Generate melt script (XML).
-    mlt_script = gen_melt_script(video_file, segments, audio_clips)
-    with open(mlt_script_path, 'w') as f:
-        f.write("<?xml version='1.0' encoding='utf-8'?>\n")
-        f.write(mlt_script)
+    with timed('gen_melt_script'):
+        write_melt_script(mlt_script_path, video_file, segments, audio_clips,
+                          video_profile, audio_track)
     # Render.
     #subprocess.call(['bash', sh_script_path])
 
-def gen_bash_script(mlt_script_path, target_path):
+def render_multi(video_file, outputs, segment_lists, audio_clip_lists):
+    """Generate render scripts of several outputs of the same video.
+
+    Args:
+        video_file: path to the input video.
+        outputs: an array of tuple (sh_script_path, mlt_script_path,
+            target_path), one for each output. See render().
+        segment_lists: an array of arrays of segments, one for each output.
+        audio_clip_lists: an array of arrays of paths to the audio clips, one
+            for each output.
+    """
+    video_profile = get_video_profiles(video_file)
+    for (sh_script_path, mlt_script_path, target_path), segments,\
+            audio_clips in zip(outputs, segment_lists, audio_clip_lists):
+        render(video_file, sh_script_path, mlt_script_path, target_path,
+               segments, audio_clips, video_profile)
+
+def render_ffmpeg(video_file, target_path, segments, audio_track=None,
+                  workers=1, chunk_length=FFMPEG_CHUNK_LENGTH, preview=False):
+    """Render the output video by 'ffmpeg', without MLT.
+
+    Each segment is cut by trim (atrim) and sped up by setpts (atempo) in a
+    filtergraph. The timeline is split into chunks of consecutive segments,
+    each encoded by its own 'ffmpeg' process reading only its range of the
+    video, and the chunks are joined by the concat demuxer without
+    re-encoding.
+
+    Args:
+        video_file: path to the input video.
+        target_path: path to the output video.
+        segments: an array of segments.
+        audio_track: path to one audio track of all segments (see
+            gen_audio_track()) used as the audio, instead of atempo.
+        workers: the number of 'ffmpeg' processes run at the same time.
+        chunk_length: the source length (in second) of a chunk, at least.
+        preview: if True, render a preview scaled down to PREVIEW_HEIGHT
+            lines with FFMPEG_PREVIEW_ARGS. Its frames are the same as those
+            of the final render.
+
+    Raises:
+        RuntimeError: 'ffmpeg' failed for some chunks.
+    """
+    segments = segment_array(segments)
+    # Start of each segment in the output (in second).
+    stretched_time = np.cumsum(np.concatenate(([0],
+        (segments.end - segments.start) / segments.ratio)))
+    chunks = ffmpeg_chunks(segments, chunk_length)
+    tmp_dir = tempfile.mkdtemp(prefix='speeda_')
+    try:
+        jobs = []
+        for n, (first, last) in enumerate(chunks):
+            chunk = segments[first:last]
+            start, end = chunk[0].start, chunk[-1].end
+            args = ['ffmpeg', '-loglevel', 'error', '-y',
+                    '-ss', '%.6f' % start, '-t', '%.6f' % (end - start),
+                    '-i', video_file]
+            if audio_track is not None:
+                args += ['-ss', '%.6f' % stretched_time[first],
+                         '-t', '%.6f' % (stretched_time[last] -
+                                         stretched_time[first]),
+                         '-i', audio_track]
+            graph = ffmpeg_filtergraph(chunk, start, audio_track is None)
+            if preview:
+                graph += ";[v]scale=-2:'min(ih,%d)'[p]" % PREVIEW_HEIGHT
+            args += ['-filter_complex', graph,
+                     '-map', '[p]' if preview else '[v]',
+                     '-map', '[a]' if audio_track is None else '1:a']
+            args += FFMPEG_PREVIEW_ARGS if preview else FFMPEG_ENCODE_ARGS
+            args.append(os.path.join(tmp_dir, 'chunk_%d.mp4' % n))
+            jobs.append(args)
+        with timed('render_ffmpeg'):
+            if workers <= 1:
+                return_codes = [run_ffmpeg(job) for job in jobs]
+            else:
+                pool = ThreadPool(workers)
+                try:
+                    # map() keeps the order of jobs.
+                    return_codes = pool.map(with_thread_hooks(run_ffmpeg),
+                                            jobs)
+                finally:
+                    pool.close()
+                    pool.join()
+            failures = ['%d (exit status %d)' % (n, code)
+                        for n, code in enumerate(return_codes) if code != 0]
+            if failures:
+                raise RuntimeError('ffmpeg failed for chunks: ' +
+                                   ', '.join(failures))
+            list_file = os.path.join(tmp_dir, 'chunks.txt')
+            with open(list_file, 'w') as f:
+                for args in jobs:
+                    f.write("file '%s'\n" % args[-1])
+            code = run_ffmpeg(['ffmpeg', '-loglevel', 'error', '-y',
+                               '-f', 'concat', '-safe', '0', '-i', list_file,
+                               '-c', 'copy', target_path])
+            if code != 0:
+                raise RuntimeError('ffmpeg failed to concatenate chunks '
+                                   '(exit status %d)' % code)
+    finally:
+        shutil.rmtree(tmp_dir)
+
+def ffmpeg_chunks(segments, chunk_length):
+    """Split segments into chunks of at least 'chunk_length' seconds (but
+    the last one).
+
+    Returns:
+        An array of tuple (first, last), the range of segments of a chunk,
+        'last' exclusive.
+    """
+    chunks = []
+    first = 0
+    for i in xrange(len(segments)):
+        if segments[i].end - segments[first].start >= chunk_length or\
+                i == len(segments) - 1:
+            chunks.append((first, i + 1))
+            first = i + 1
+    return chunks
+
+def ffmpeg_filtergraph(segments, offset, audio=True):
+    """Generate the 'ffmpeg' filtergraph of a chunk of segments.
+
+    Args:
+        segments: an array of segments.
+        offset: the time (in second) of the first frame of the input.
+        audio: if True, the audio is sped up by atempo too.
+
+    Returns:
+        The filtergraph, with the output video labeled [v] (and audio [a]).
+    """
+    filters = []
+    streams = ''
+    for i, s in enumerate(segments):
+        trim = 'start=%.6f:end=%.6f' % (s.start - offset, s.end - offset)
+        filters.append('[0:v]trim=%s,setpts=(PTS-STARTPTS)/%r[v%d]' % (
+            trim, float(s.ratio), i))
+        streams += '[v%d]' % i
+        if audio:
+            filters.append('[0:a]atrim=%s,asetpts=PTS-STARTPTS,%s[a%d]' % (
+                trim, atempo_filters(s.ratio), i))
+            streams += '[a%d]' % i
+    filters.append('%sconcat=n=%d:v=1:a=%d[v]%s' % (
+        streams, len(segments), int(audio), '[a]' if audio else ''))
+    return ';'.join(filters)
+
+def atempo_filters(ratio):
+    """Return a chain of atempo filters speeding audio up by 'ratio'. Each
+    filter stays in [0.5, 2], which every 'ffmpeg' version accepts."""
+    filters = []
+    while ratio > 2:
+        filters.append('atempo=2')
+        ratio /= 2.0
+    while ratio < 0.5:
+        filters.append('atempo=0.5')
+        ratio /= 0.5
+    filters.append('atempo=%r' % float(ratio))
+    return ','.join(filters)
+
+def run_ffmpeg(args):
+    """Run 'ffmpeg' with arguments 'args'. Returns its exit status."""
+    count('ffmpeg_spawned')
+    with timed('ffmpeg', 'subprocess'):
+        return subprocess.call(args)
+
+def gen_bash_script(mlt_script_path, target_path, preview=False):
     """Generate and returns the BASH script used to render output video.
 
     Args:
         mlt_script_path: path to the MLT script to be generated.
         target_path: path to the output video.
+        preview: if True, render a low-resolution, low-bitrate preview with
+            fast encoding options. The profile (hence the frame rate) and the
+            MLT script are the same, so the preview has the same frames as
+            the final render.
 
     Returns:
         Content of the BASH script.
@@ -410,86 +1603,184 @@ def gen_bash_script(mlt_script_path, target_path):
     s += 'TARGET="' + target_abs_path + '"\n'
     s += 'RENDERER="/usr/bin/kdenlive_render"\n'
     s += 'MELT="/usr/bin/melt"\n'
-    s += 'PARAMETERS="-pid:24332 $MELT hdv_1080_50i avformat - '\
-         '$SOURCE $TARGET f=mp4 acodec=libmp3lame ab=128k ar=44100 '\
-         'vcodec=mpeg4 minrate=0 vb=12000k aspect=@16/9 mbd=2 trellis=1 '\
-         'mv4=1 pass=1 threads=1 real_time=-1"\n'
+    if preview:
+        s += 'PARAMETERS="-pid:24332 $MELT hdv_1080_50i avformat - '\
+             '$SOURCE $TARGET f=mp4 acodec=libmp3lame ab=64k ar=44100 '\
+             'vcodec=mpeg4 minrate=0 vb=500k s=%dx%d aspect=@16/9 '\
+             'threads=1 real_time=-1"\n' % (PREVIEW_HEIGHT * 16 // 9,
+                                             PREVIEW_HEIGHT)
+    else:
+        s += 'PARAMETERS="-pid:24332 $MELT hdv_1080_50i avformat - '\
+             '$SOURCE $TARGET f=mp4 acodec=libmp3lame ab=128k ar=44100 '\
+             'vcodec=mpeg4 minrate=0 vb=12000k aspect=@16/9 mbd=2 trellis=1 '\
+             'mv4=1 pass=1 threads=1 real_time=-1"\n'
     s += '$RENDERER $PARAMETERS\n'
     return s
 
-def gen_melt_script(video_file, segments, audio_clips):
+def gen_melt_script(video_file, segments, audio_clips, video_profile=None,
+                    audio_track=None):
     """Generate and returns the MLT script used to render output video.
 
     Args:
         video_file: path to the input video.
         segments: an array of segments.
         audio_clips: an array of paths to the audio clip of its video segment.
+        video_profile: (frame_rate, frame_length) of the video, None to get it
+            by get_video_profiles().
+        audio_track: see write_melt_script().
 
     Returns:
         Content of the MLT script.
     """
+    output = io.BytesIO()
+    write_melt_script(output, video_file, segments, audio_clips, video_profile,
+                      audio_track)
+    return output.getvalue()
+
+def write_melt_script(output, video_file, segments, audio_clips,
+                      video_profile=None, audio_track=None):
+    """Write the MLT script used to render output video.
+
+    The script is written node by node, so the XML document is never held in
+    memory as a whole.
+
+    Args:
+        output: path to the MLT script, or a file object.
+        video_file: path to the input video.
+        segments: an array of segments.
+        audio_clips: an array of paths to the audio clip of its video segment.
+            Ignored if 'audio_track' is given.
+        video_profile: (frame_rate, frame_length) of the video, None to get it
+            by get_video_profiles().
+        audio_track: path to one audio track of all segments (see
+            gen_audio_track()). If given, the audio track has a single
+            producer, and each clip refers to it by in and out points,
+            instead of a producer for each audio clip.
+    """
     # Some useful info.
-    frame_rate, frame_length = get_video_profiles(video_file)
+    if video_profile is None:
+        video_profile = get_video_profiles(video_file)
+    frame_rate, frame_length = video_profile
     video_time = segments[-1].end # video time in second.
     root_dir = os.path.dirname(os.path.abspath(video_file))
     video_base_name = os.path.basename(video_file)
-    # XML elements
+    clips = melt_clips(segments, frame_length, video_time)
     title = 'Speeda'
-    mlt = E('mlt', {'title': title, 'version': '0.9.0', 'root': root_dir,\
-                    'LC_NUMERIC': 'en_US.UTF-8'})
-    audio_track = E('playlist', {'id': 'playlist3'}) # Audio track.
-    video_track = E('playlist', {'id': 'playlist5'}) # Video track.
-    # Add clips to audio/video track.
-    video_ids = set()
-    final_frame_length = 0
-    for i in xrange(len(segments)):
-        s = segments[i]
-        video_producer_id = 'slowmotion:2:%.2f' % s.ratio
-        producer_frame_length = int(frame_length / s.ratio)
-        video_resource = video_base_name + '?%.2f' % s.ratio
-        start_frame = int(s.start / video_time * producer_frame_length)
-        end_frame = int(s.end / video_time * producer_frame_length) - 1
+    node_count = 0
+    with ET.xmlfile(output, encoding='utf-8') as xf:
+        xf.write_declaration()
+        with xf.element('mlt', {'title': title, 'version': '0.9.0',
+                                'root': root_dir,
+                                'LC_NUMERIC': 'en_US.UTF-8'}):
+            xf.write('\n')
+            nodes = []
+            # Producers.
+            video_ids = set()
+            for i, (s, start_frame, end_frame, audio_in) in enumerate(clips):
+                video_producer_id = 'slowmotion:2:%.2f' % s.ratio
+                if video_producer_id not in video_ids:
+                    # only create one <producer> node if same speed-up ratio.
+                    video_ids.add(video_producer_id)
+                    nodes.append(create_producer_node(video_producer_id,
+                        int(frame_length / s.ratio),
+                        video_base_name + '?%.2f' % s.ratio, is_video=True))
+                if audio_track is None:
+                    nodes.append(create_producer_node('audio_%d' % i,
+                        end_frame - start_frame + 1, audio_clips[i],
+                        is_video=False))
+                for node in nodes:
+                    xf.write(node)
+                    xf.write('\n')
+                    node_count += sum(1 for _ in node.iter())
+                del nodes[:]
+            if audio_track is not None:
+                _, start_frame, end_frame, audio_in = clips[-1]
+                node = create_producer_node('audio_track',
+                    audio_in + end_frame - start_frame + 1, audio_track,
+                    is_video=False)
+                xf.write(node)
+                xf.write('\n')
+                node_count += sum(1 for _ in node.iter())
+            # Tracks.
+            for playlist_id in ['playlist1', 'playlist2', 'playlist3',
+                                'playlist4', 'playlist5']:
+                with xf.element('playlist', {'id': playlist_id}):
+                    node_count += 1
+                    if playlist_id == 'playlist3': # Audio track.
+                        entries = melt_audio_entries(clips, audio_track)
+                    elif playlist_id == 'playlist5': # Video track.
+                        entries = melt_video_entries(clips)
+                    else: # Empty track.
+                        entries = []
+                    for entry in entries:
+                        xf.write('\n')
+                        xf.write(entry)
+                        node_count += 1
+                xf.write('\n')
+            # Tractor.
+            final_frame_length = sum(end_frame - start_frame + 1
+                                     for _, start_frame, end_frame, _ in clips)
+            tractor = E('tractor', {'title': title, 'global_feed': '1',
+                                    'in': '0',
+                                    'out': str(final_frame_length - 1),
+                                    'id': 'maintractor'})
+            tractor.append(E('track', {'hide': 'video',
+                                       'producer': 'playlist1'}))
+            tractor.append(E('track', {'hide': 'video',
+                                       'producer': 'playlist2'}))
+            tractor.append(E('track', {'producer': 'playlist3'}))
+            tractor.append(E('track', {'producer': 'playlist4'}))
+            tractor.append(E('track', {'producer': 'playlist5'}))
+            xf.write(tractor)
+            xf.write('\n')
+            node_count += 6
+    if active_hooks():
+        count('xml_nodes', node_count + 1)
+
+def melt_clips(segments, frame_length, video_time):
+    """Calculate the frames of each clip of the MLT script.
+
+    Args:
+        segments: an array of segments.
+        frame_length: the frame length of the video.
+        video_time: the length of the video (in second).
+
+    Returns:
+        An array of tuple (segment, start_frame, end_frame, audio_in): the
+        clip's frames in the video producer of its ratio, and its first frame
+        in an audio track of all segments.
+    """
+    bounds = segment_array(segments)
+    producer_frame_length = (frame_length / bounds.ratio).astype(int)
+    start_frame = (bounds.start / video_time *
+                   producer_frame_length).astype(int)
+    end_frame = (bounds.end / video_time *
+                 producer_frame_length).astype(int) - 1
+    # start of each clip in the audio track (in second)
+    stretched_time = np.cumsum(np.concatenate(([0],
+        (bounds.end - bounds.start) / bounds.ratio)))[:-1]
+    audio_in = np.around(stretched_time / video_time *
+                         frame_length).astype(int)
+    return zip(segments, start_frame.tolist(), end_frame.tolist(),
+               audio_in.tolist())
+
+def melt_video_entries(clips):
+    """Generate the <entry> nodes of the video track of the MLT script."""
+    for s, start_frame, end_frame, _ in clips:
+        yield E('entry', {'in': str(start_frame), 'out': str(end_frame),
+                          'producer': 'slowmotion:2:%.2f' % s.ratio})
+
+def melt_audio_entries(clips, audio_track=None):
+    """Generate the <entry> nodes of the audio track of the MLT script."""
+    for i, (_, start_frame, end_frame, audio_in) in enumerate(clips):
         clip_frame_length = end_frame - start_frame + 1
-        final_frame_length += clip_frame_length
-        # Video producer.
-        if video_producer_id not in video_ids:
-            # only create one <producer> node if same speed-up ratio.
-            video_ids.add(video_producer_id)
-            video_producer = create_producer_node(video_producer_id,\
-                                                  producer_frame_length,
-                                                  video_resource, is_video=True)
-            mlt.append(video_producer)
-        # Audio producer.
-        audio_producer_id = 'audio_%d' % i
-        audio_resource = audio_clips[i]
-        audio_producer = create_producer_node(audio_producer_id,\
-                                              clip_frame_length,
-                                              audio_resource, is_video=False)
-        mlt.append(audio_producer)
-        # Video clip.
-        video_track.append(E('entry', {'in': str(start_frame),
-                                       'out': str(end_frame),
-                                       'producer': video_producer_id}))
-        # Audio clip.
-        audio_track.append(E('entry', {'in': '0',
-                                       'out': str(clip_frame_length - 1),
-                                       'producer': audio_producer_id}))
-    mlt.append(E('playlist', {'id': 'playlist1'})) # Empty track.
-    mlt.append(E('playlist', {'id': 'playlist2'})) # Empty track.
-    mlt.append(audio_track)
-    mlt.append(E('playlist', {'id': 'playlist4'})) # Empty track.
-    mlt.append(video_track)
-    # Tractor.
-    tractor = E('tractor', {'title': title, 'global_feed': '1',
-                            'in': '0', 'out': str(final_frame_length - 1),
-                            'id': 'maintractor'})
-    tractor.append(E('track', {'hide': 'video', 'producer': 'playlist1'}))
-    tractor.append(E('track', {'hide': 'video', 'producer': 'playlist2'}))
-    tractor.append(E('track', {'producer': 'playlist3'}))
-    tractor.append(E('track', {'producer': 'playlist4'}))
-    tractor.append(E('track', {'producer': 'playlist5'}))
-    mlt.append(tractor)
-    return ET.tostring(mlt, pretty_print=True)
+        if audio_track is None:
+            yield E('entry', {'in': '0', 'out': str(clip_frame_length - 1),
+                              'producer': 'audio_%d' % i})
+        else:
+            yield E('entry', {'in': str(audio_in),
+                              'out': str(audio_in + clip_frame_length - 1),
+                              'producer': 'audio_track'})
 
 def create_producer_node(producer_id, frame_length, resource, is_video):
     """Create a <producer> node of MLT script. An example is given below.
@@ -523,15 +1814,34 @@ def create_producer_node(producer_id, frame_length, resource, is_video):
 def get_video_profiles(video_file):
     """Returns profile (info) of a video.
 
+    MP4/MOV files are probed by reading their headers; other containers by
+    'melt'. Results are memoized by the path, modification time and size of
+    the video.
+
     Args:
         video_file: path to the video.
 
     Returns:
         A tuple of (frame_rate, frame_length).
     """
-    p = subprocess.Popen(['melt', video_file, '-consumer', 'xml'],
-                         stdout=subprocess.PIPE)
-    stdout, stderr = p.communicate()
+    stat = os.stat(video_file)
+    key = (os.path.abspath(video_file), stat.st_mtime, stat.st_size)
+    if key not in video_profiles:
+        profile = probe_mp4(video_file)
+        if profile is None:
+            profile = probe_melt(video_file)
+        video_profiles[key] = profile
+    return video_profiles[key]
+
+# Memoized results of get_video_profiles().
+video_profiles = {}
+
+def probe_melt(video_file):
+    """Returns (frame_rate, frame_length) of a video, by 'melt'."""
+    with timed('melt', 'subprocess'):
+        p = subprocess.Popen(['melt', video_file, '-consumer', 'xml'],
+                             stdout=subprocess.PIPE)
+        stdout, stderr = p.communicate()
     # Parse XML.
     root = ET.fromstring(stdout)
     # Get useful info.
@@ -541,13 +1851,245 @@ def get_video_profiles(video_file):
             frame_length = int(property_tag.text)
     return frame_rate, frame_length
 
+def probe_mp4(video_file):
+    """Returns (frame_rate, frame_length) of a MP4/MOV video from its headers.
+
+    Only the 'moov' atom is read: the time scale of the first video track
+    (mdhd) and its sample table (stts), which gives the number of frames and
+    their duration. Like the profile of 'melt', frame_rate is the numerator
+    of the frame rate, e.g. 30000 for 29.97 (30000/1001) fps.
+
+    Args:
+        video_file: path to the video.
+
+    Returns:
+        A tuple of (frame_rate, frame_length), or None if the video is not a
+        MP4/MOV file, has no video track or its headers are malformed.
+    """
+    moov = None
+    with open(video_file, 'rb') as f:
+        f.seek(0, os.SEEK_END)
+        file_size = f.tell()
+        pos = 0
+        while pos + 8 <= file_size:
+            f.seek(pos)
+            header = f.read(16)
+            size, kind = struct.unpack('>I4s', header[:8])
+            header_size = 8
+            if size == 1:
+                if len(header) < 16:
+                    return None
+                size, = struct.unpack('>Q', header[8:16])
+                header_size = 16
+            elif size == 0:
+                size = file_size - pos
+            if (size < header_size or pos + size > file_size or
+                    (pos == 0 and kind not in MP4_ATOMS)):
+                return None
+            if kind == b'moov':
+                f.seek(pos + header_size)
+                moov = f.read(size - header_size)
+                break
+            pos += size
+    if moov is None:
+        return None
+    for kind, start, end in mp4_atoms(moov, 0, len(moov)):
+        if kind != b'trak':
+            continue
+        hdlr = find_mp4_atom(moov, start, end, [b'mdia', b'hdlr'])
+        if hdlr is None or moov[hdlr[0] + 8:hdlr[0] + 12] != b'vide':
+            continue
+        mdhd = find_mp4_atom(moov, start, end, [b'mdia', b'mdhd'])
+        stts = find_mp4_atom(moov, start, end,
+                             [b'mdia', b'minf', b'stbl', b'stts'])
+        if mdhd is None or stts is None or stts[1] - stts[0] < 8:
+            return None
+        version, = struct.unpack('>B', moov[mdhd[0]:mdhd[0] + 1])
+        offset = mdhd[0] + (20 if version == 1 else 12)
+        if offset + 4 > mdhd[1]:
+            return None
+        timescale, = struct.unpack('>I', moov[offset:offset + 4])
+        entry_count, = struct.unpack('>I', moov[stts[0] + 4:stts[0] + 8])
+        table = moov[stts[0] + 8:stts[0] + 8 + 8 * entry_count]
+        if len(table) != 8 * entry_count or entry_count == 0:
+            return None
+        entries = np.frombuffer(table, dtype='>u4').reshape(-1, 2)
+        # (sample count, sample duration); the most common duration wins.
+        frame_length = int(entries[:, 0].sum())
+        delta = int(entries[np.argmax(entries[:, 0]), 1])
+        frame_rate = fractions.Fraction(timescale, delta).numerator
+        return frame_rate, frame_length
+    return None
+
+# Atoms a MP4/MOV file may start with.
+MP4_ATOMS = (b'ftyp', b'moov', b'mdat', b'free', b'skip', b'wide', b'pnot')
+
+def mp4_atoms(data, start, end):
+    """Generate (type, body_start, body_end) of atoms in data[start:end]."""
+    pos = start
+    while pos + 8 <= end:
+        size, kind = struct.unpack('>I4s', data[pos:pos + 8])
+        header_size = 8
+        if size == 1:
+            if pos + 16 > end:
+                return
+            size, = struct.unpack('>Q', data[pos + 8:pos + 16])
+            header_size = 16
+        elif size == 0:
+            size = end - pos
+        if size < header_size or pos + size > end:
+            return
+        yield kind, pos + header_size, pos + size
+        pos += size
+
+def find_mp4_atom(data, start, end, path):
+    """Find the atom at 'path' (an array of atom types) in data[start:end].
+
+    Returns:
+        A tuple of (body_start, body_end), or None if there isn't such atom.
+    """
+    for kind, body_start, body_end in mp4_atoms(data, start, end):
+        if kind == path[0]:
+            if len(path) == 1:
+                return body_start, body_end
+            return find_mp4_atom(data, body_start, body_end, path[1:])
+    return None
+
+# Instrumentation hooks. Each hook is called as hook(event, name, value), where
+# event is 'stage' (value: seconds spent in the stage), 'subprocess' (value:
+# seconds spent in the process) or 'count' (value: a number to add to the
+# counter). Without hooks, instrumentation costs a list check per call.
+hooks = []
+# Hooks of the job run by a thread (see thread_hook()), on top of 'hooks'.
+thread_hooks = threading.local()
+
+def add_hook(hook):
+    """Register an instrumentation hook, e.g. a Profiler instance."""
+    hooks.append(hook)
+
+def remove_hook(hook):
+    """Unregister an instrumentation hook."""
+    hooks.remove(hook)
+
+@contextlib.contextmanager
+def thread_hook(hook):
+    """Context manager registering a hook for this thread only, e.g. to
+    profile one of several jobs run by threads. Thread pools of the job pass
+    it on to their threads by with_thread_hooks()."""
+    saved = getattr(thread_hooks, 'hooks', [])
+    thread_hooks.hooks = saved + [hook]
+    try:
+        yield
+    finally:
+        thread_hooks.hooks = saved
+
+def with_thread_hooks(func):
+    """Return a function running 'func' with the thread hooks of this
+    thread, to run in another thread (e.g. of a thread pool)."""
+    job_hooks = getattr(thread_hooks, 'hooks', [])
+    if not job_hooks:
+        return func
+    def run(*args):
+        saved = getattr(thread_hooks, 'hooks', [])
+        thread_hooks.hooks = job_hooks
+        try:
+            return func(*args)
+        finally:
+            thread_hooks.hooks = saved
+    return run
+
+def active_hooks():
+    """Return the hooks of this thread: 'hooks' and its thread hooks."""
+    return hooks + getattr(thread_hooks, 'hooks', [])
+
+def count(name, value=1):
+    """Add 'value' to the counter 'name' of the hooks."""
+    for hook in active_hooks():
+        hook('count', name, value)
+
+@contextlib.contextmanager
+def timed(name, event='stage'):
+    """Context manager reporting the time spent in it to the hooks.
+
+    Args:
+        name: name of the stage or subprocess.
+        event: 'stage' or 'subprocess'.
+    """
+    stage_hooks = active_hooks()
+    if not stage_hooks:
+        yield
+        return
+    start = time.time()
+    try:
+        yield
+    finally:
+        elapsed = time.time() - start
+        for hook in stage_hooks:
+            hook(event, name, elapsed)
+
+# An instrumentation hook collecting events into a report: time, calls and
+# peak RSS after each stage; counters (and their value in each event); and
+# durations of subprocesses. Thread-safe, as clips run in a thread pool.
+class Profiler:
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.stages = {}
+        self.counters = {}
+        self.subprocesses = {}
+
+    def __call__(self, event, name, value):
+        with self.lock:
+            if event == 'stage':
+                stage = self.stages.setdefault(name, {'seconds': 0.0,
+                                                      'calls': 0})
+                stage['seconds'] += value
+                stage['calls'] += 1
+                stage['peak_rss'] = peak_rss()
+            elif event == 'subprocess':
+                self.subprocesses.setdefault(name, []).append(value)
+            elif event == 'count':
+                self.counters.setdefault(name, []).append(value)
+
+    def report(self):
+        """Return the report as a dict, which can be dumped to JSON."""
+        with self.lock:
+            return {
+                'stages': dict((k, dict(v)) for k, v in self.stages.items()),
+                'counters': dict((k, sum(v))
+                                 for k, v in self.counters.items()),
+                # Value of each event, e.g. Harma iterations of each batch,
+                # except for plain tallies.
+                'counter_events': dict((k, list(v))
+                                       for k, v in self.counters.items()
+                                       if any(x != 1 for x in v)),
+                'subprocesses': dict((k, {'calls': len(v),
+                                          'seconds': sum(v),
+                                          'max_seconds': max(v)})
+                                     for k, v in self.subprocesses.items()),
+                'peak_rss': peak_rss(),
+                'peak_rss_children': peak_rss(children=True),
+            }
+
+    def write_report(self, path):
+        """Write the report to 'path' as JSON."""
+        with open(path, 'w') as f:
+            json.dump(self.report(), f, indent=2, sort_keys=True)
+
+def peak_rss(children=False):
+    """Return the peak RSS (in bytes) of this process, or of its largest
+    terminated child process."""
+    who = resource.RUSAGE_CHILDREN if children else resource.RUSAGE_SELF
+    # ru_maxrss is in KB on Linux.
+    return resource.getrusage(who).ru_maxrss * 1024
+
 def exp_harma():
     """Small experiment on Harma parameters."""
+    import matplotlib.pyplot as plt # slow to import, only needed here
     audio_file = 'playground/ai_short/ai_short.wav'
     audio, fs = load_audio(audio_file)
     syllable_times = detect_syllables(audio, fs)
-    start_time = [start for (start, end) in syllable_times]
-    end_time = [end for (start, end) in syllable_times]
+    start_time = syllable_times.start
+    end_time = syllable_times.end
 
     plt.close('all')
     plt.figure()
@@ -557,13 +2099,265 @@ def exp_harma():
     plt.title('Detected syllables (start: level 1, end: level 0.9)')
     plt.show()
 
-# A syllable detected by Harma. Only keep relevant info here.
-class Syllable:
-    def __init__(self, times):
-        self.times = times
+# Mono audio data backed by an array of PCM samples, e.g. a memory-mapped WAV
+# file. Slicing it converts only the sliced samples to float in range [-1, 1].
+class PcmAudio:
+    def __init__(self, pcm, dtype='float32'):
+        self.pcm = pcm
+        self.dtype = np.dtype(dtype)
+        self.shape = pcm.shape[:1]
+        self.size = pcm.shape[0]
+
+    def __len__(self):
+        return self.size
+
+    def __getitem__(self, index):
+        return pcm2float(self.pcm[index], self.dtype)
+
+# State of stream_segments(). Audio flows through the same stages as
+# calc_speedup_ratio(), each keeping only what it needs from the stage before:
+#   samples -> frame peaks -> Harma batches -> syllables -> votes ->
+#   median-filtered votes -> splitting points -> segments.
+# Each stage knows how far its output is final (e.g. votes are final up to
+# 0.3 s before the earliest syllable which may still be found).
+class SegmentStream:
+    def __init__(self, fs, speed, batch_length=STREAM_BATCH_LENGTH):
+        self.fs = fs
+        self.speed = speed
+        hop = HARMA_NFFT - HARMA_NOVERLAP
+        self.batch_frames = max(1, int(batch_length * fs) // hop)
+        self.block_frames = max(1, STFT_MAX_MEMORY //
+                                   stft_frame_bytes(HARMA_NFFT))
+        self.sample_count = 0
+        self.samples = np.zeros(0, dtype=np.float32) # not framed yet
+        self.frame_count = 0
+        self.peaks = np.zeros(0) # of frames from batch_start
+        self.batch_start = 0
+        self.open_syllable = None # (start_frame, end_frame) at batch end
+        self.syllable_starts = np.zeros(0) # in ms, not counted yet
+        # Votes: difference array from vote_base; final votes up to vote_end.
+        self.vote_base = 0
+        self.vote_diff = np.zeros(0, dtype=np.int64)
+        self.vote_carry = 0
+        self.votes = np.zeros(0, dtype=np.int64) # from votes_base
+        self.votes_base = 0
+        self.vote_end = 0
+        # Median-filtered votes are final up to median_end.
+        self.median_end = 0
+        self.last_median = None
+        self.in_valley = True
+        self.valley_start = 0
+        # Segments and the running estimate of the ratio.
+        self.segment_start = 0
+        self.segment_count = 0
+        self.density_sum = 0.0
+        self.speak_weight = 0.0
+        self.pause_count = 0
+
+    def feed(self, block):
+        """Add a block of audio data. Returns the newly final segments."""
+        self.samples = np.concatenate((self.samples, block))
+        self.sample_count += len(block)
+        self.add_frames(count_frames(self.sample_count)
+                        if self.sample_count >= HARMA_NFFT else 0)
+        syllables = []
+        while self.peaks.size >= self.batch_frames:
+            syllables += self.run_batch(self.batch_frames, False)
+        if self.open_syllable is not None:
+            frontier = frame_time(self.open_syllable[0], self.fs)
+        else:
+            frontier = frame_time(self.batch_start, self.fs)
+        # No syllable found later votes before this.
+        vote_end = int(np.floor((frontier - 0.3) * 1000)) - 1
+        return self.add_syllables(syllables, max(vote_end, 0), False)
+
+    def close(self):
+        """End the audio. Returns the remaining segments."""
+        if self.sample_count < HARMA_NFFT:
+            # zero pad audio up to nfft, as specgram() does.
+            self.samples = np.concatenate((self.samples, np.zeros(
+                HARMA_NFFT - self.sample_count, dtype=self.samples.dtype)))
+        self.add_frames(count_frames(self.sample_count))
+        syllables = []
+        while self.peaks.size > 0:
+            batch_frames = min(self.peaks.size, self.batch_frames)
+            syllables += self.run_batch(batch_frames,
+                                        batch_frames == self.peaks.size)
+        size = int(float(self.sample_count) / self.fs * 1000) # in ms
+        return self.add_syllables(syllables, size, True)
+
+    def add_frames(self, frame_count):
+        """Compute peaks of the frames up to 'frame_count'."""
+        new_frames = frame_count - self.frame_count
+        if new_frames <= 0:
+            return
+        peaks = [np.amax(mag, axis=0) for _, mag in
+                 stft_blocks(self.samples, self.block_frames, 0, new_frames)]
+        self.peaks = np.concatenate([self.peaks] + peaks)
+        hop = HARMA_NFFT - HARMA_NOVERLAP
+        self.samples = self.samples[new_frames * hop:]
+        self.frame_count = frame_count
+
+    def run_batch(self, batch_frames, last):
+        """Run Harma on the next batch, like harma_batch() does.
+
+        Returns:
+            An array of tuple (start, end) of the final syllables.
+        """
+        batch_start = self.batch_start
+        batch_end = batch_start + batch_frames
+        frames = harma_frames(self.peaks[:batch_frames],
+                              include_start=batch_start > 0,
+                              include_end=not last)
+        self.peaks = self.peaks[batch_frames:]
+        self.batch_start = batch_end
+        syllables = []
+        open_syllable = self.open_syllable
+        self.open_syllable = None
+        for start, end in frames:
+            start += batch_start
+            end += batch_start
+            if start == batch_start and open_syllable is not None:
+                # The syllable crosses the batch boundary.
+                start = open_syllable[0]
+                open_syllable = None
+            if end == batch_end - 1 and not last:
+                self.open_syllable = (start, end)
+            else:
+                syllables.append((start, end))
+        if open_syllable is not None:
+            syllables.append(open_syllable)
+        return [(frame_time(start_frame, self.fs),
+                 frame_time(end_frame, self.fs))
+                for start_frame, end_frame in syllables]
+
+    def add_syllables(self, syllables, vote_end, last):
+        """Vote for final syllables, and advance the votes to 'vote_end'.
+
+        Returns:
+            An array of the newly final segments.
+        """
+        if syllables:
+            times = syllable_array(syllables)
+            self.syllable_starts = np.sort(np.concatenate(
+                (self.syllable_starts, 1000 * times.start)))
+            # Same voting range as calc_vote_density().
+            vote_start = np.floor((times.start - 0.3) * 1000).astype(int) - 1
+            vote_stop = np.floor((times.end + 0.3) * 1000).astype(int)
+            vote_start = np.maximum(vote_start, 0)
+            voted = vote_start < vote_stop
+            vote_start, vote_stop = vote_start[voted], vote_stop[voted]
+            if vote_stop.size:
+                grow = vote_stop.max() + 1 - self.vote_base -\
+                       self.vote_diff.size
+                if grow > 0:
+                    self.vote_diff = np.concatenate(
+                        (self.vote_diff, np.zeros(grow, dtype=np.int64)))
+                np.add.at(self.vote_diff, vote_start - self.vote_base, 1)
+                np.add.at(self.vote_diff, vote_stop - self.vote_base, -1)
+        if vote_end <= self.vote_end:
+            return []
+        # Final votes.
+        diff = self.vote_diff[:vote_end - self.vote_base]
+        diff = np.concatenate((diff, np.zeros(vote_end - self.vote_base -
+                                              diff.size, dtype=np.int64)))
+        votes = self.vote_carry + np.cumsum(diff)
+        self.vote_carry = votes[-1]
+        self.vote_diff = self.vote_diff[vote_end - self.vote_base:]
+        self.vote_base = vote_end
+        self.votes = np.concatenate((self.votes, votes))
+        self.vote_end = vote_end
+        # Median filtering, final up to half a window before the final votes.
+        window_size = 151
+        half = window_size // 2
+        median_end = vote_end if last else vote_end - half
+        if median_end <= self.median_end:
+            return []
+        low = max(0, self.median_end - half)
+        median = running_median(self.votes[low - self.votes_base:],
+                                window_size)
+        median = median[self.median_end - low:median_end - low]
+        median_start = self.median_end
+        self.median_end = median_end
+        keep = max(0, median_end - half) - self.votes_base
+        self.votes = self.votes[keep:]
+        self.votes_base += keep
+        seg_points = self.split(median, median_start)
+        if last:
+            # Make sure 'seg_points' has the end point of the votes.
+            seg_points.append(vote_end - 1)
+        return self.merge(seg_points)
+
+    def split(self, median, median_start):
+        """Find splitting points in the median-filtered votes, like
+        calc_segments() does."""
+        if self.last_median is None:
+            values = median
+            offset = median_start
+        else:
+            values = np.concatenate(([self.last_median], median))
+            offset = median_start - 1
+        if median.size:
+            self.last_median = median[-1]
+        changes = np.flatnonzero(np.diff(values)) + 1
+        rising = values[changes] > values[changes - 1]
+        changes += offset
+        valley_ends = rising & np.concatenate(([self.in_valley],
+                                               ~rising[:-1]))
+        valley_starts = np.concatenate(([self.valley_start], changes[:-1]))
+        if changes.size:
+            self.in_valley = not rising[-1]
+            if self.in_valley:
+                self.valley_start = changes[-1]
+        seg_points = np.empty(2 * np.count_nonzero(valley_ends),
+                              dtype=np.int64)
+        seg_points[0::2] = valley_starts[valley_ends]
+        seg_points[1::2] = changes[valley_ends]
+        return list(seg_points)
+
+    def merge(self, seg_points):
+        """Merge splitting points into segments, like calc_segments() does,
+        and calculate their ratio, like calc_ratios() does but with the
+        density and length of the audio so far."""
+        min_segment_length = 400 # in ms
+        pause_time = 150 # desired pause time (in ms)
+        segments = []
+        for point in seg_points:
+            if point - self.segment_start <= min_segment_length:
+                continue
+            seg_start, seg_end = self.segment_start, int(point)
+            self.segment_start = seg_end
+            seg_length = seg_end - seg_start
+            count = np.searchsorted(self.syllable_starts, seg_end, 'left')
+            self.syllable_starts = self.syllable_starts[count:]
+            density = float(count) / seg_length
+            self.segment_count += 1
+            self.density_sum += density
+            avg_density = self.density_sum / self.segment_count
+            if density == 0 and seg_length > pause_time:
+                self.pause_count += 1
+                ratio = (seg_length - 1) // pause_time
+            else:
+                self.speak_weight += (seg_length - 1) * density
+                speak_time = self.speak_weight / avg_density\
+                             if avg_density > 0 else 0
+                expected_time = seg_end / self.speed
+                remaining = expected_time - self.pause_count * pause_time
+                if density > 0 and speak_time > 0 and remaining > 0:
+                    desired_ratio = speak_time / remaining
+                    ratio = avg_density * desired_ratio / density
+                else: # no estimate yet
+                    ratio = self.speed
+            ratio = max(0.1, min(100, np.around(ratio, decimals=2)))
+            segments.append(Segment(float(seg_start) / 1000,
+                                    float(seg_end) / 1000,
+                                    quantize_speedup_ratio(ratio)))
+        return segments
 
 # A segment with start time, end time, and its speed-up ratio.
 # Time is in second. e.g. start = 1.234 means 1.234 second.
+# The pipeline keeps segments in record arrays (see segment_array()), whose
+# elements have the same attributes.
 class Segment:
     def __init__(self, start, end, ratio):
         self.start = start
@@ -574,18 +2368,563 @@ class Segment:
         return '(start, end, ratio) = (%.2f, %.2f, %.2f)' % (\
                 self.start, self.end, self.ratio)
 
-if __name__ == '__main__':
+def find_videos(inputs, manifest=None):
+    """Find the videos to process.
+
+    Args:
+        inputs: an array of paths to videos, or to directories of videos.
+        manifest: path to a text file listing a video on each line (blank
+            lines and lines starting with '#' are ignored), or None.
+
+    Returns:
+        An array of absolute paths to the videos, in the given order.
+    """
+    paths = list(inputs)
+    if manifest is not None:
+        with open(manifest) as f:
+            paths += [line.strip() for line in f
+                      if line.strip() and not line.strip().startswith('#')]
+    videos = []
+    for path in paths:
+        if os.path.isdir(path):
+            for name in sorted(os.listdir(path)):
+                if os.path.splitext(name)[1].lower() in VIDEO_EXTENSIONS:
+                    videos.append(os.path.abspath(os.path.join(path, name)))
+        else:
+            videos.append(os.path.abspath(path))
+    return videos
+
+VIDEO_EXTENSIONS = ('.mp4', '.mov', '.m4v', '.mkv', '.avi', '.flv', '.webm')
+
+def extract_audio(video_file):
+    """Return the path to the WAV audio of a video, extracting it by 'ffmpeg'
+    (next to the video) if it doesn't exist yet."""
+    audio_file = os.path.splitext(video_file)[0] + '.wav'
+    if not os.path.exists(audio_file):
+        # Extract to a temporary file, so that a concurrent job never reads
+        # a partial file.
+        fd, tmp_path = tempfile.mkstemp(
+            suffix='.wav', dir=os.path.dirname(os.path.abspath(audio_file)))
+        os.close(fd)
+        try:
+            with timed('ffmpeg', 'subprocess'):
+                code = subprocess.call(['ffmpeg', '-loglevel', 'error', '-y',
+                                        '-i', video_file, '-vn', '-f', 'wav',
+                                        tmp_path])
+            if code != 0:
+                raise RuntimeError('ffmpeg failed to extract audio of ' +
+                                   video_file)
+            os.rename(tmp_path, audio_file)
+        finally:
+            if os.path.exists(tmp_path):
+                os.remove(tmp_path)
+    return audio_file
+
+def analysis_job(job):
+    """Analyze a video of a batch, run in a process of the analysis pool.
+
+    Args:
+        job: a tuple of (video_file, speed, cache_dir, analysis_rate,
+            profile), where profile is whether to profile the analysis.
+
+    Returns:
+        A tuple of (video_file, segments, error, report), where error is None
+        or the message of the exception which stopped the analysis, and
+        report is the report of a Profiler, or None if not profiled.
+    """
+    video_file, speed, cache_dir, analysis_rate, profile = job
+    profiler = Profiler() if profile else None
+    if profiler is not None:
+        add_hook(profiler)
+    try:
+        with timed('analysis'):
+            segments = calc_speedup_ratio(video_file, speed, cache_dir,
+                                          analysis_rate=analysis_rate)
+    except Exception as e:
+        segments, error = None, '%s: %s' % (type(e).__name__, e)
+    else:
+        error = None
+    finally:
+        if profiler is not None:
+            remove_hook(profiler)
+    return (video_file, segments, error,
+            profiler.report() if profiler is not None else None)
+
+def render_job(video_file, segments, speed, output_dir, engine,
+               backend='melt', workers=1, preview=False):
+    """Generate audio clips and render scripts of an analyzed video, or
+    render it by render_ffmpeg() if 'backend' is 'ffmpeg'. A preview is
+    named with '_preview'. The audio clips (or track) are named after the
+    output, next to the video, so that outputs don't share them. 'workers'
+    is the number of processes run at the same time for this video: 'sox'
+    processes of gen_audio_clips(), or 'ffmpeg' processes of
+    render_ffmpeg().
+
+    Returns:
+        Path to the output video.
+    """
+    clip_name = output_name(video_file, speed, preview)
+    base_path = os.path.join(output_dir or os.path.dirname(video_file),
+                             clip_name)
+    audio_clips, audio_track = None, None
+    if engine == 'track':
+        audio_track = gen_audio_track(video_file, segments, clip_name)
+    if backend == 'ffmpeg':
+        # The audio is sped up by atempo, unless there is an audio track,
+        # whose path is relative to the directory of the video.
+        if audio_track is not None:
+            audio_track = os.path.join(
+                os.path.dirname(os.path.abspath(video_file)), audio_track)
+        render_ffmpeg(video_file, base_path + '.mp4', segments, audio_track,
+                      workers, preview=preview)
+        return base_path + '.mp4'
+    if engine == 'wsola':
+        audio_clips = gen_audio_clips(video_file, segments, engine,
+                                      base_name=clip_name)
+    elif engine == 'sox': # 'sox' reads a WAV file.
+        audio_clips = gen_audio_clips(extract_audio(video_file), segments,
+                                      engine, workers, base_name=clip_name)
+    render(video_file, base_path + '.sh', base_path + '.sh.mlt',
+           base_path + '.mp4', segments, audio_clips, audio_track=audio_track,
+           preview=preview)
+    return base_path + '.mp4'
+
+def output_name(video_file, speed, preview=False):
+    """Return the name (without extension) of the output of a video."""
+    base_name = os.path.splitext(os.path.basename(video_file))[0]
+    name = '%s_speeda_%.2f' % (base_name, speed)
+    if preview:
+        name += '_preview'
+    return name
+
+def job_key(video_file, speed, preview=False):
+    """Return the key of the state of a job of run_batch()."""
+    return '%s@%.2f%s' % (video_file, speed, ' preview' if preview else '')
+
+def run_batch(videos, speed, jobs=1, render_jobs=None, state_file=None,
+              output_dir=None, engine='sox', cache_dir=CACHE_DIR,
+              backend='melt', analysis_rate=ANALYSIS_SAMPLE_RATE,
+              preview=False, profile_dir=None):
+    """Process videos with a pool of processes for analysis (CPU-bound) and a
+    pool of threads for clips and rendering (bound by subprocesses).
+
+    A video is rendered as soon as its analysis finishes. Its state is saved
+    to 'state_file' (JSON) after each step, and videos already done in a
+    previous run with the same speed are skipped.
+
+    Args:
+        videos: an array of paths to videos.
+        speed: desired speed specified by user.
+        jobs: the number of analysis processes.
+        render_jobs: the number of render threads, None for 'jobs'.
+        state_file: path to the job state file, None to not keep state.
+        output_dir: directory of the outputs (created if missing), None for
+            next to each video.
+        engine: engine of gen_audio_clips(), or 'track' for one audio track
+            by gen_audio_track().
+        cache_dir: directory of the analysis cache, None to disable caching.
+        backend: 'melt' to generate MLT render scripts, or 'ffmpeg' to render
+            by render_ffmpeg(). The cores are shared by the render threads,
+            for 'sox' or 'ffmpeg' processes.
+        analysis_rate: sampling rate Harma analyzes the audio at, None for
+            the rate of the audio. See detect_syllables().
+        preview: if True, render low-resolution previews, whose frames are
+            the same as those of the final renders. Previews are tracked in
+            the state apart from final renders.
+        profile_dir: directory (created if missing) to write the profile of
+            each video to, as JSON named after its output, None not to
+            profile. The profile has the Profiler report of the 'analysis'
+            (in a process of the analysis pool) and of the 'render' (in a
+            render thread).
+
+    Returns:
+        A dict of job key (see job_key()) to its state.
+    """
+    state = {}
+    if state_file is not None and os.path.exists(state_file):
+        with open(state_file) as f:
+            state = json.load(f)
+    lock = threading.Lock()
+    def update(video_file, **values):
+        with lock:
+            state[job_key(video_file, speed, preview)] = values
+            if state_file is not None:
+                with open(state_file + '.tmp', 'w') as f:
+                    json.dump(state, f, indent=2, sort_keys=True)
+                os.rename(state_file + '.tmp', state_file)
+    todo = [v for v in videos if state.get(job_key(v, speed, preview),
+                                           {}).get('status') != 'done']
+    if output_dir is not None:
+        make_dirs(output_dir)
+    if profile_dir is not None:
+        make_dirs(profile_dir)
+    # Fork the analysis pool before the render pool starts any thread.
+    analysis_pool = multiprocessing.Pool(jobs)
+    render_pool = ThreadPool(render_jobs or jobs)
+    workers = max(1, multiprocessing.cpu_count() // (render_jobs or jobs))
+    def write_profile(video_file, analysis_report, render_report=None):
+        profile = {'video': video_file, 'speed': speed,
+                   'analysis': analysis_report, 'render': render_report}
+        path = os.path.join(profile_dir,
+                            output_name(video_file, speed, preview) + '.json')
+        with open(path, 'w') as f:
+            json.dump(profile, f, indent=2, sort_keys=True)
+    def render_task(video_file, segments, analysis_report):
+        profiler = Profiler() if profile_dir is not None else None
+        try:
+            if profiler is not None:
+                with thread_hook(profiler), timed('render'):
+                    target = render_job(video_file, segments, speed,
+                                        output_dir, engine, backend, workers,
+                                        preview)
+            else:
+                target = render_job(video_file, segments, speed, output_dir,
+                                    engine, backend, workers, preview)
+        except Exception as e:
+            update(video_file, status='failed',
+                   error='%s: %s' % (type(e).__name__, e))
+        else:
+            update(video_file, status='done', output=target)
+        if profiler is not None:
+            write_profile(video_file, analysis_report, profiler.report())
+    def analyzed(result):
+        video_file, segments, error, analysis_report = result
+        if error is not None:
+            update(video_file, status='failed', error=error)
+            if profile_dir is not None:
+                write_profile(video_file, analysis_report)
+        else:
+            update(video_file, status='analyzed')
+            render_pool.apply_async(render_task, (video_file, segments,
+                                                  analysis_report))
+    try:
+        for video_file in todo:
+            analysis_pool.apply_async(analysis_job,
+                                      ((video_file, speed, cache_dir,
+                                        analysis_rate,
+                                        profile_dir is not None),),
+                                      callback=analyzed)
+        analysis_pool.close()
+        analysis_pool.join()
+    finally:
+        analysis_pool.terminate()
+        render_pool.close()
+        render_pool.join()
+    return state
+
+def daemon_job(job):
+    """Analyze and render a video in a process of the pool of the daemon,
+    profiling its stages.
+
+    Args:
+        job: a tuple of (video_file, speed, options), where options is a dict
+            of 'cache_dir', 'analysis_rate', 'output_dir', 'engine',
+            'backend', 'workers' and 'preview'. See render_job().
+
+    Returns:
+        A tuple of (output, error, profile), where output is the path to the
+        output video, error is None or the message of the exception which
+        stopped the job, and profile is the report of a Profiler.
+    """
+    video_file, speed, options = job
+    profiler = Profiler()
+    add_hook(profiler)
+    try:
+        with timed('analysis'):
+            segments = calc_speedup_ratio(
+                video_file, speed, options['cache_dir'],
+                analysis_rate=options['analysis_rate'])
+        with timed('render'):
+            output = render_job(video_file, segments, speed,
+                                options['output_dir'], options['engine'],
+                                options['backend'], options['workers'],
+                                options['preview'])
+    except Exception as e:
+        return None, '%s: %s' % (type(e).__name__, e), profiler.report()
+    finally:
+        remove_hook(profiler)
+    return output, None, profiler.report()
+
+def is_number(value):
+    """Return whether a value (e.g. decoded from JSON) is a finite number."""
+    if not isinstance(value, (int, long, float)) or isinstance(value, bool):
+        return False
+    try:
+        value = float(value)
+    except OverflowError: # An integer too large for a float.
+        return False
+    return not math.isinf(value) and not math.isnan(value)
+
+# Jobs of the daemon, run by a bounded pool of processes. The pool is forked
+# once from the daemon, so its processes start with the modules imported and
+# keep memoized state (e.g. video profiles) warm between jobs. Each process
+# is fed by a thread, which keeps the state of its job. Thread-safe.
+class JobQueue:
+    def __init__(self, workers, defaults):
+        self.lock = threading.Lock()
+        self.jobs = {}
+        self.next_id = 1
+        self.defaults = dict(defaults)
+        self.defaults['workers'] = max(1, multiprocessing.cpu_count() //
+                                          workers)
+        # Ctrl-C stops the daemon, which terminates the pool.
+        self.pool = multiprocessing.Pool(workers, signal.signal,
+                                         (signal.SIGINT, signal.SIG_IGN))
+        self.threads = ThreadPool(workers)
+
+    def submit(self, request):
+        """Queue a job.
+
+        A job of the same video, speed and preview flag as a queued or
+        running job is refused, as they would write the same audio clips.
+
+        Args:
+            request: a dict of 'video' (path to the video) and, to override
+                the defaults of the daemon, any of DAEMON_OPTIONS.
+
+        Returns:
+            The state of the job. See get().
+
+        Raises:
+            ValueError: the request is invalid.
+        """
+        if not isinstance(request, dict) or\
+                not isinstance(request.get('video'), basestring):
+            raise ValueError('a job needs the path of a \'video\'')
+        unknown = set(request) - set(DAEMON_OPTIONS) - set(['video'])
+        if unknown:
+            raise ValueError('unknown options: ' + ', '.join(sorted(unknown)))
+        options = dict(self.defaults)
+        options.update(request)
+        video_file = os.path.abspath(options.pop('video'))
+        speed = options.pop('speed')
+        if not os.path.isfile(video_file):
+            raise ValueError('no such video: ' + video_file)
+        if not is_number(speed) or speed <= 0:
+            raise ValueError('speed must be a positive number')
+        speed = float(speed)
+        if options['output_dir'] is not None and\
+                not isinstance(options['output_dir'], basestring):
+            raise ValueError('output_dir must be a path or null')
+        if options['output_dir'] is not None:
+            options['output_dir'] = os.path.abspath(options['output_dir'])
+            try:
+                make_dirs(options['output_dir'])
+            except OSError as e:
+                raise ValueError('cannot create output_dir: %s' % e)
+        if options['engine'] not in ('sox', 'wsola', 'track'):
+            raise ValueError('unknown engine: %s' % options['engine'])
+        if options['backend'] not in ('melt', 'ffmpeg'):
+            raise ValueError('unknown backend: %s' % options['backend'])
+        if not isinstance(options['preview'], bool):
+            raise ValueError('preview must be true or false')
+        rate = options['analysis_rate']
+        if rate is not None and (not is_number(rate) or rate <= 0 or
+                                 rate != int(rate)):
+            raise ValueError('analysis_rate must be a positive integer or '
+                             'null')
+        key = job_key(video_file, speed, options['preview'])
+        with self.lock:
+            for job in self.jobs.values():
+                if job['status'] in ('queued', 'running') and\
+                        job_key(job['video'], job['speed'],
+                                job['preview']) == key:
+                    raise ValueError('job %s of the same video, speed and '
+                                     'preview is not finished yet' %
+                                     job['id'])
+            job_id = str(self.next_id)
+            self.next_id += 1
+            self.jobs[job_id] = {'id': job_id, 'video': video_file,
+                                 'speed': speed, 'preview': options['preview'],
+                                 'status': 'queued', 'submitted': time.time()}
+        self.threads.apply_async(self.run, (job_id, video_file, speed,
+                                            options))
+        return self.get(job_id)
+
+    def run(self, job_id, video_file, speed, options):
+        """Run a job in the pool, updating its state."""
+        self.update(job_id, status='running', started=time.time())
+        try:
+            output, error, profile = self.pool.apply(
+                daemon_job, ((video_file, speed, options),))
+        except Exception as e: # e.g. the process was killed
+            output, error, profile = None, '%s: %s' % (type(e).__name__,
+                                                       e), None
+        finished = time.time()
+        job = self.get(job_id)
+        self.update(job_id, status='failed' if error else 'done',
+                    finished=finished, seconds=finished - job['started'],
+                    output=output, error=error, profile=profile)
+
+    def update(self, job_id, **values):
+        with self.lock:
+            self.jobs[job_id].update(values)
+
+    def get(self, job_id=None):
+        """Return the state of a job, or a list of the states of all jobs if
+        'job_id' is None.
+
+        The state is a dict of 'id', 'video', 'speed', 'preview', 'status'
+        ('queued', 'running', 'done' or 'failed') and the times it was
+        'submitted', 'started' and 'finished' at. A finished job also has
+        'seconds' (running time), 'output', 'error' and 'profile' (the
+        report of a Profiler, with the time spent in each stage). None if
+        there is no such job.
+        """
+        with self.lock:
+            if job_id is None:
+                return [dict(self.jobs[k])
+                        for k in sorted(self.jobs, key=int)]
+            if job_id not in self.jobs:
+                return None
+            return dict(self.jobs[job_id])
+
+    def close(self):
+        """Stop the pool, dropping queued and running jobs."""
+        self.pool.terminate()
+        self.threads.terminate()
+
+# HTTP handler of the daemon: POST /jobs queues a job (a JSON object, see
+# JobQueue.submit()), GET /jobs lists the jobs and GET /jobs/<id> returns
+# the state of a job (see JobQueue.get()), as JSON.
+class DaemonHandler(BaseHTTPServer.BaseHTTPRequestHandler):
+    def do_GET(self):
+        if self.path.rstrip('/') == '/jobs':
+            self.reply(200, self.server.queue.get())
+        elif self.path.startswith('/jobs/'):
+            job = self.server.queue.get(self.path[len('/jobs/'):])
+            if job is None:
+                self.reply(404, {'error': 'no such job'})
+            else:
+                self.reply(200, job)
+        else:
+            self.reply(404, {'error': 'unknown path: ' + self.path})
+
+    def do_POST(self):
+        if self.path.rstrip('/') != '/jobs':
+            self.reply(404, {'error': 'unknown path: ' + self.path})
+            return
+        try:
+            length = int(self.headers.get('Content-Length', 0))
+            job = self.server.queue.submit(json.loads(self.rfile.read(length)))
+        except ValueError as e: # including malformed JSON
+            self.reply(400, {'error': str(e)})
+        else:
+            self.reply(202, job)
+
+    def reply(self, code, body):
+        data = json.dumps(body, indent=2, sort_keys=True) + '\n'
+        self.send_response(code)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(data)))
+        self.end_headers()
+        self.wfile.write(data)
+
+class DaemonServer(SocketServer.ThreadingMixIn, BaseHTTPServer.HTTPServer):
+    daemon_threads = True
+
+def serve(port=DAEMON_PORT, workers=1, **defaults):
+    """Run Speeda as a daemon, which takes jobs over HTTP on localhost until
+    it is interrupted or terminated.
+
+    A job is analyzed and rendered as by run_batch(), by a pool of 'workers'
+    processes which stay warm between jobs. For example:
+        curl -d '{"video": "/videos/talk.mp4", "speed": 1.5}' \\
+            localhost:8395/jobs
+        curl localhost:8395/jobs/1
+
+    Args:
+        port: port to listen to, 0 for any free port.
+        workers: the number of jobs run at the same time.
+        defaults: the default 'speed', 'output_dir', 'engine', 'backend',
+            'preview', 'analysis_rate' and 'cache_dir' of the jobs.
+    """
+    # Fork the pool before the server starts any thread.
+    queue = JobQueue(workers, defaults)
+    server = DaemonServer(('127.0.0.1', port), DaemonHandler)
+    server.queue = queue
+    def stop(signum, frame):
+        raise KeyboardInterrupt
+    signal.signal(signal.SIGTERM, stop)
+    print 'Speeda daemon listening on 127.0.0.1:%d' % server.server_address[1]
+    sys.stdout.flush()
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
+        queue.close()
+
+def main(argv=None):
     """Main function of Speeda."""
-    #exp_harma()
-    #sys.exit(0)
-
-    audio_file = 'playground/ai/ai.wav' # TODO extract from video
-    video_file = 'playground/ai/ai.mp4'
-    sh_script_path = 'playground/ai/test.sh'
-    mlt_script_path = sh_script_path + '.mlt'
-    target_path = 'playground/ai/test.mp4'
-
-    segments = calc_speedup_ratio(audio_file, 1)
-    audio_clips = gen_audio_clips(audio_file, segments)
-    render(video_file, sh_script_path, mlt_script_path, target_path,\
-           segments, audio_clips)
+    parser = argparse.ArgumentParser(
+        description='Speed up videos adaptively to the speech rate.')
+    parser.add_argument('inputs', nargs='*',
+                        help='videos, or directories of videos')
+    parser.add_argument('-m', '--manifest',
+                        help='text file listing a video on each line')
+    parser.add_argument('-s', '--speed', type=float, default=1.0,
+                        help='desired speed (default: 1.0)')
+    parser.add_argument('-j', '--jobs', type=int,
+                        default=multiprocessing.cpu_count(),
+                        help='number of analysis processes (default: cores)')
+    parser.add_argument('--render-jobs', type=int,
+                        help='number of render threads (default: --jobs)')
+    parser.add_argument('--state', help='job state file, to resume a batch')
+    parser.add_argument('-o', '--output-dir',
+                        help='output directory (default: next to the video)')
+    parser.add_argument('--engine', choices=['sox', 'wsola', 'track'],
+                        default='sox',
+                        help='engine to generate audio clips, or \'track\' '
+                             'for one audio track stretched by WSOLA')
+    parser.add_argument('--backend', choices=['melt', 'ffmpeg'],
+                        default='melt',
+                        help='write MLT render scripts, or render by ffmpeg '
+                             '(the audio is sped up by atempo, unless '
+                             '--engine is \'track\')')
+    parser.add_argument('--no-cache', action='store_true',
+                        help='disable the analysis cache')
+    parser.add_argument('--analysis-rate', type=int,
+                        help='sampling rate the syllables are detected at, '
+                             'e.g. 16000 (default: the rate of the audio)')
+    parser.add_argument('--preview', action='store_true',
+                        help='render a low-resolution preview, with the same '
+                             'frames as the final render')
+    parser.add_argument('--profile', metavar='DIR',
+                        help='write the profile of the stages of each video '
+                             'to DIR, as JSON')
+    parser.add_argument('--daemon', action='store_true',
+                        help='run as a daemon taking jobs over HTTP on '
+                             'localhost, with the other options as their '
+                             'defaults and --jobs workers')
+    parser.add_argument('--port', type=int, default=DAEMON_PORT,
+                        help='port of the daemon (default: %d)' %
+                             DAEMON_PORT)
+    args = parser.parse_args(argv)
+    if args.daemon:
+        serve(args.port, args.jobs, speed=args.speed,
+              output_dir=args.output_dir, engine=args.engine,
+              backend=args.backend, preview=args.preview,
+              analysis_rate=args.analysis_rate,
+              cache_dir=None if args.no_cache else CACHE_DIR)
+        return 0
+    videos = find_videos(args.inputs, args.manifest)
+    if not videos:
+        parser.error('no video to process')
+    state = run_batch(videos, args.speed, args.jobs, args.render_jobs,
+                      args.state, args.output_dir, args.engine,
+                      None if args.no_cache else CACHE_DIR, args.backend,
+                      args.analysis_rate, args.preview, args.profile)
+    failed = 0
+    for video_file in videos:
+        job = state.get(job_key(video_file, args.speed, args.preview), {})
+        print '%-8s %s' % (job.get('status', 'unknown'), video_file)
+        if job.get('status') != 'done':
+            failed += 1
+            if 'error' in job:
+                print '         ' + job['error']
+    return 1 if failed else 0
+
+if __name__ == '__main__':
+    sys.exit(main())
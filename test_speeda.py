@@ -0,0 +1,421 @@
+#!/usr/bin/python
+"""Tests of Speeda.
+
+Usage:
+    python -m unittest test_speeda
+"""
+
+import os
+import shutil
+import struct
+import tempfile
+import time
+import unittest
+import warnings
+
+import numpy as np
+import scipy.signal
+
+import speeda
+
+def calc_vote_density_loop(syllable_times, audio, fs):
+    """The original calc_vote_density(): votes by a loop over each syllable's
+    range, then scipy.signal.medfilt()."""
+    voteWindow = 0.3 # in second
+    vote_density = np.zeros(int(float(audio.size) / fs * 1000), # in ms
+                            dtype=np.uint32)
+    for start, end in syllable_times:
+        vote_start = int(np.floor((start - voteWindow) * 1000)) - 1
+        vote_end = int(np.floor((end + voteWindow) * 1000))
+        if vote_start < 0:
+            vote_start = 0
+        if vote_end > vote_density.size:
+            vote_end = vote_density.size
+        for i in xrange(vote_start, vote_end):
+            vote_density[i] += 1
+    return scipy.signal.medfilt(vote_density, 151)
+
+def calc_segments_loop(vote_density):
+    """The original calc_segments(): finds splitting points and merges them
+    into segments by loops."""
+    seg_points = np.array([0], dtype=np.uint32)
+    in_valley = True
+    valley_start = 0
+    for m in xrange(1, vote_density.size):
+        if vote_density[m - 1] < vote_density[m]:
+            if in_valley: # valley ends
+                seg_points = np.append(seg_points, [valley_start, m])
+            in_valley = False
+        elif vote_density[m - 1] > vote_density[m]:
+            valley_start = m
+            in_valley = True
+    if seg_points[-1] != vote_density.size:
+        seg_points = np.append(seg_points, vote_density.size - 1)
+    min_segment_length = 400 # in ms
+    start_points = np.array([0])
+    seg_start = seg_points[0]
+    for m in xrange(1, seg_points.size):
+        if seg_points[m] - seg_start > min_segment_length:
+            start_points = np.append(start_points, seg_points[m])
+            seg_start = seg_points[m]
+    return start_points
+
+def calc_syllable_density_loop(start_points, syllable_times):
+    """The original calc_syllable_density(): counts syllables by a loop."""
+    syllable_density = np.zeros(len(start_points) - 1)
+    index = 0
+    for i in xrange(1, len(start_points)):
+        count = 0
+        while index < len(syllable_times) and\
+                1000 * syllable_times[index][0] < start_points[i]:
+            index += 1
+            count += 1
+        syllable_density[i - 1] = float(count) /\
+                                  (start_points[i] - start_points[i - 1])
+    return syllable_density
+
+def calc_ratios_loop(start_points, syllable_density, speed, audio, fs):
+    """The original calc_ratios(): calculates the ratios by loops."""
+    pause_time = 150 # desired pause time (in ms)
+    avg_density = np.mean(syllable_density)
+    pause_count = 0
+    speak_time = 0
+    for m in xrange(1, start_points.size):
+        seg_start, seg_end = start_points[m - 1], start_points[m]
+        if syllable_density[m - 1] == 0 and seg_end - seg_start > pause_time:
+            pause_count += 1
+        else:
+            ratio = avg_density / syllable_density[m - 1]
+            speak_time += float(seg_end - 1 - seg_start) / ratio
+    audio_length = float(audio.size) / fs * 1000 # audio length in ms.
+    expected_time = audio_length / speed
+    desired_ratio = speak_time / (expected_time - pause_count * pause_time)
+    speedup_ratio = np.zeros(0)
+    for m in xrange(1, start_points.size):
+        seg_start, seg_end = start_points[m - 1], start_points[m]
+        if syllable_density[m - 1] == 0 and seg_end - seg_start > pause_time:
+            ratio = (seg_end - 1 - seg_start) // pause_time
+        else:
+            ratio = avg_density * desired_ratio / syllable_density[m - 1]
+        speedup_ratio = np.append(speedup_ratio, ratio)
+    return speedup_ratio
+
+def random_density(rng, size):
+    """Return a random vote density of 'size' ms: plateaus of random length
+    and height, like median-filtered votes."""
+    count = rng.randint(1, max(2, size // 50))
+    heights = rng.randint(0, 6, count)
+    lengths = rng.multinomial(size, np.ones(count) / count)
+    return np.repeat(heights, lengths).astype(np.uint32)
+
+def harma_loop(mag, T):
+    """The original harma(): rescans the spectrogram for its maximum for each
+    syllable, and clears the frames of the syllable found. Returns an array of
+    tuple (start, end) of the times T of the frames of each syllable, in the
+    order they are found. Unlike the original, stops on a silent
+    spectrogram rather than looping forever."""
+    minDB = speeda.HARMA_MIN_DB
+    mag = np.array(mag, dtype=np.float64)
+    syllables = []
+    cutoff = None
+    with np.errstate(divide='ignore'):
+        while True:
+            freqMax = np.amax(mag, axis=0)
+            argMax = np.amax(freqMax)
+            if argMax == 0:
+                break
+            segmentIndex = freqMax.argmax()
+            segments = [segmentIndex]
+            amps = [20 * np.log10(argMax)]
+            if cutoff is None:
+                cutoff = amps[0] - minDB
+            if amps[0] < cutoff:
+                break
+            minAmp = amps[0] - minDB
+            i = 0
+            t = segmentIndex
+            while t > 0 and amps[i] >= minAmp:
+                t -= 1
+                i += 1
+                segments.append(t)
+                amps.append(20 * np.log10(freqMax[t]))
+            if i > 0:
+                del segments[i], amps[i]
+                i -= 1
+            while t < freqMax.size - 1 and amps[i] >= minAmp:
+                t += 1
+                i += 1
+                segments.append(t)
+                amps.append(20 * np.log10(freqMax[t]))
+            if i > 0:
+                del segments[i], amps[i]
+                i -= 1
+            times = np.asarray(T)[segments]
+            syllables.append((np.amin(times), np.amax(times)))
+            mag[:, segments] = 0
+    return syllables
+
+def harma_spectrogram(audio, fs):
+    """Return the magnitude spectrogram of Harma and the time of its frames,
+    like pylab.specgram() computed them for the original harma()."""
+    nfft, noverlap = speeda.HARMA_NFFT, speeda.HARMA_NOVERLAP
+    hop = nfft - noverlap
+    audio = np.concatenate((audio, np.zeros(max(nfft - audio.size, 0))))
+    frame_count = (audio.size - noverlap) // hop
+    frames = np.array([audio[k * hop:k * hop + nfft]
+                       for k in xrange(frame_count)])
+    window = np.kaiser(nfft, speeda.HARMA_KAISER_BETA)
+    mag = np.abs(np.fft.rfft(frames * window, axis=1)).T
+    return mag, (np.arange(frame_count) * hop + nfft / 2.0) / fs
+
+def random_syllables(rng, duration, count, max_length=0.3):
+    """Return 'count' random syllables (start, end) in about 'duration'
+    seconds, some of them out of the audio at either end."""
+    start = np.sort(rng.uniform(-0.5, duration + 0.5, count))
+    end = start + rng.uniform(0.01, max_length, count)
+    return zip(start, end)
+
+class VoteDensityTest(unittest.TestCase):
+    fs = 16000
+
+    def check(self, syllable_times, duration):
+        audio = np.zeros(int(duration * self.fs))
+        expected = calc_vote_density_loop(syllable_times, audio, self.fs)
+        actual = speeda.calc_vote_density(syllable_times, audio, self.fs)
+        self.assertEqual(actual.dtype, expected.dtype)
+        np.testing.assert_array_equal(actual, expected)
+
+    def test_empty(self):
+        self.check([], 3)
+
+    def test_empty_audio(self):
+        self.check([(0.1, 0.2)], 0)
+
+    def test_clipped_at_edges(self):
+        # Voting ranges cut at the start and the end of the audio, and
+        # syllables entirely out of it.
+        self.check([(0.0, 0.1), (0.2, 0.4), (2.8, 3.2), (3.5, 3.6),
+                    (-1.0, -0.5)], 3)
+
+    def test_high_votes(self):
+        # Many syllables overlapping the same window.
+        rng = np.random.RandomState(0)
+        self.check(random_syllables(rng, 1, 200, max_length=1), 4)
+
+    def test_random(self):
+        rng = np.random.RandomState(1)
+        for _ in xrange(40):
+            duration = rng.uniform(0.5, 20)
+            self.check(random_syllables(rng, duration,
+                                        rng.randint(0, 5 * duration)),
+                       duration)
+
+    def test_record_array(self):
+        rng = np.random.RandomState(2)
+        syllable_times = random_syllables(rng, 10, 40)
+        audio = np.zeros(10 * self.fs)
+        np.testing.assert_array_equal(
+            speeda.calc_vote_density(speeda.syllable_array(syllable_times),
+                                     audio, self.fs),
+            calc_vote_density_loop(syllable_times, audio, self.fs))
+
+class RunningMedianTest(unittest.TestCase):
+    def test_medfilt(self):
+        rng = np.random.RandomState(3)
+        for size in (0, 1, 5, 151, 1000):
+            for max_vote in (0, 1, 7, 50):
+                votes = rng.randint(0, max_vote + 1, size).astype(np.uint32)
+                for window_size in (1, 3, 151):
+                    np.testing.assert_array_equal(
+                        speeda.running_median(votes, window_size),
+                        scipy.signal.medfilt(votes, window_size))
+
+class SegmentationTest(unittest.TestCase):
+    fs = 16000
+
+    def densities(self):
+        rng = np.random.RandomState(8)
+        yield np.zeros(0, dtype=np.uint32)
+        yield np.array([3], dtype=np.uint32)
+        yield np.zeros(1000, dtype=np.uint32)
+        for _ in xrange(100):
+            yield random_density(rng, rng.randint(1, 20000))
+
+    def test_calc_segments(self):
+        for vote_density in self.densities():
+            np.testing.assert_array_equal(
+                speeda.calc_segments(vote_density),
+                calc_segments_loop(vote_density))
+
+    def test_calc_syllable_density(self):
+        rng = np.random.RandomState(9)
+        for vote_density in self.densities():
+            start_points = speeda.calc_segments(vote_density)
+            duration = vote_density.size / 1000.0
+            for count in (0, 1, rng.randint(0, 5 * duration + 2)):
+                syllable_times = sorted(random_syllables(rng, duration,
+                                                         count))
+                np.testing.assert_array_equal(
+                    speeda.calc_syllable_density(start_points,
+                                                 syllable_times),
+                    calc_syllable_density_loop(start_points, syllable_times))
+
+    def test_calc_ratios(self):
+        rng = np.random.RandomState(10)
+        for vote_density in self.densities():
+            if vote_density.size == 0:
+                continue # the original divides by zero
+            start_points = speeda.calc_segments(vote_density)
+            duration = vote_density.size / 1000.0
+            syllable_times = sorted(random_syllables(
+                rng, duration, rng.randint(0, 5 * duration + 2)))
+            syllable_density = speeda.calc_syllable_density(start_points,
+                                                            syllable_times)
+            audio = np.zeros(int(duration * self.fs))
+            for speed in (0.5, 1.5, 3):
+                with warnings.catch_warnings():
+                    warnings.simplefilter('ignore')
+                    np.testing.assert_allclose(
+                        speeda.calc_ratios(start_points, syllable_density,
+                                           speed, audio, self.fs),
+                        calc_ratios_loop(start_points, syllable_density,
+                                         speed, audio, self.fs),
+                        rtol=1e-9)
+
+class HarmaTest(unittest.TestCase):
+    def check_frames(self, freqMax):
+        freqMax = np.asarray(freqMax, dtype=np.float64)
+        expected = harma_loop(freqMax[np.newaxis, :], np.arange(freqMax.size))
+        self.assertEqual(speeda.harma_frames(freqMax), expected)
+
+    def test_silent(self):
+        self.check_frames(np.zeros(50))
+        self.check_frames([0.0])
+
+    def test_edges(self):
+        # Peaks on the first and the last frame, and runs reaching them.
+        self.check_frames([9, 1, 0.5, 1, 2])
+        self.check_frames([1, 2, 0.5, 3, 9])
+        self.check_frames([5, 5, 5, 5])
+        self.check_frames([5, 0.01, 0.01, 5])
+        self.check_frames([7])
+
+    def test_ties(self):
+        rng = np.random.RandomState(5)
+        for _ in xrange(100):
+            self.check_frames(rng.randint(0, 4, rng.randint(1, 60)) *
+                              rng.choice([1, 0.05]))
+
+    def test_random(self):
+        rng = np.random.RandomState(6)
+        for _ in xrange(100):
+            size = rng.randint(1, 300)
+            self.check_frames(rng.uniform(0, 1, size) ** rng.uniform(1, 20))
+
+    def test_harma(self):
+        rng = np.random.RandomState(7)
+        fs = 16000
+        signals = [np.zeros(fs), np.zeros(100), rng.randn(100)]
+        for _ in xrange(20):
+            size = rng.randint(1, 2 * fs)
+            signals.append(rng.randn(size) * rng.uniform(0, 1, size) ** 4)
+        for audio in signals:
+            mag, T = harma_spectrogram(audio, fs)
+            expected = np.array(harma_loop(mag, T)).reshape(-1, 2)
+            actual = speeda.harma(audio, fs)
+            np.testing.assert_allclose(actual.start, expected[:, 0])
+            np.testing.assert_allclose(actual.end, expected[:, 1])
+
+class HarmaBatchTest(unittest.TestCase):
+    def test_single_batch(self):
+        # Audio shorter than a batch gives the syllables of harma(), edges
+        # of the audio included.
+        rng = np.random.RandomState(4)
+        for _ in xrange(50):
+            size = rng.randint(256, 3 * 16000)
+            audio = rng.randn(size) * rng.uniform(0, 1, size) ** 4
+            expected = np.sort(speeda.harma(audio, 16000), order='start')
+            actual = speeda.harma_batch(audio, 16000)
+            np.testing.assert_array_equal(actual.start, expected.start)
+            np.testing.assert_array_equal(actual.end, expected.end)
+
+def mp4_atom(kind, body):
+    return struct.pack('>I4s', 8 + len(body), kind) + body
+
+def mp4_video(frame_count=300, timescale=30000, delta=1001):
+    """Return a minimal MP4 with one video track of 'frame_count' frames."""
+    hdlr = mp4_atom(b'hdlr', b'\0' * 8 + b'vide' + b'\0' * 12)
+    mdhd = mp4_atom(b'mdhd', b'\0' * 12 + struct.pack('>II', timescale, 0))
+    stts = mp4_atom(b'stts', struct.pack('>IIII', 0, 1, frame_count,
+                                          delta))
+    stbl = mp4_atom(b'stbl', stts)
+    minf = mp4_atom(b'minf', stbl)
+    mdia = mp4_atom(b'mdia', mdhd + hdlr + minf)
+    return mp4_atom(b'ftyp', b'isom') + mp4_atom(b'moov',
+                                                  mp4_atom(b'trak', mdia))
+
+class ProbeMp4Test(unittest.TestCase):
+    def probe(self, data):
+        fd, path = tempfile.mkstemp(suffix='.mp4')
+        try:
+            with os.fdopen(fd, 'wb') as f:
+                f.write(data)
+            return speeda.probe_mp4(path)
+        finally:
+            os.remove(path)
+
+    def test_video(self):
+        self.assertEqual(self.probe(mp4_video()), (30000, 300))
+
+    def test_oversized_moov(self):
+        # A 64-bit moov size far past the end of the file.
+        data = (mp4_atom(b'ftyp', b'isom') +
+                struct.pack('>I4sQ', 1, b'moov', 2 ** 40) + b'\0' * 64)
+        self.assertIsNone(self.probe(data))
+
+    def test_truncated_moov(self):
+        self.assertIsNone(self.probe(mp4_video()[:-4]))
+
+class AnalysisCacheTest(unittest.TestCase):
+    def setUp(self):
+        self.cache_dir = tempfile.mkdtemp(prefix='speeda_test_')
+
+    def tearDown(self):
+        shutil.rmtree(self.cache_dir)
+
+    def analysis(self):
+        return (speeda.syllable_array([(0.1, 0.2)]),
+                np.zeros(1000), np.array([0, 999]), 1000.0)
+
+    def test_round_trip(self):
+        speeda.save_analysis(self.cache_dir, 'a', self.analysis())
+        analysis = speeda.load_analysis(self.cache_dir, 'a')
+        self.assertEqual(analysis[3], 1000.0)
+        np.testing.assert_array_equal(analysis[2], [0, 999])
+        self.assertIsNone(speeda.load_analysis(self.cache_dir, 'b'))
+
+    def test_stale_temporary_files(self):
+        # Left over by a killed process, or still being written.
+        stale = os.path.join(self.cache_dir, 'stale.npz.tmp')
+        fresh = os.path.join(self.cache_dir, 'fresh.npz.tmp')
+        for path in (stale, fresh):
+            with open(path, 'wb') as f:
+                f.write(b'\0' * 100)
+        old = time.time() - speeda.CACHE_TMP_MAX_AGE - 10
+        os.utime(stale, (old, old))
+        speeda.save_analysis(self.cache_dir, 'a', self.analysis())
+        self.assertEqual(sorted(os.listdir(self.cache_dir)),
+                         ['a.npz', 'fresh.npz.tmp'])
+
+class IsNumberTest(unittest.TestCase):
+    def test_numbers(self):
+        for value in (0, 2, 1.5, -3, 10 ** 20):
+            self.assertTrue(speeda.is_number(value))
+
+    def test_not_numbers(self):
+        for value in (True, None, '2', [1], float('nan'), float('inf'),
+                      -float('inf'), 10 ** 400):
+            self.assertFalse(speeda.is_number(value))
+
+if __name__ == '__main__':
+    unittest.main()